@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+############################################################################
+# File Name: generate
+# Description: synthetic BAM/CRAM/VCF cohorts with known sex karyotypes
+############################################################################
+
+import argparse, os, random, shutil, subprocess
+
+# Small genome: one autosome, chrX, and the part of chrY around SRY (hg19) that reads map to
+CONTIGS = [("1", 1000000), ("X", 600000), ("Y", 2800000)]
+Y_MAPPABLE = (2600000, 2800000)
+READ_LENGTH = 100
+INSERT = 300
+# (X copies, Y copies) of each karyotype
+KARYOTYPES = {"XX": (2, 0), "XY": (1, 1), "XXY": (2, 1), "XYY": (1, 2), "X": (1, 0), "XXX": (3, 0)}
+DEFAULT_MIX = "XX:0.47,XY:0.47,XXY:0.015,XYY:0.015,X:0.015,XXX:0.015"
+
+def parse_mix(mix):
+    '''Parse "XX:0.5,XY:0.5" into a {karyotype: weight} dict'''
+    weights = {}
+    for item in mix.split(","):
+        karyotype, weight = item.split(":")
+        if karyotype not in KARYOTYPES:
+            raise ValueError(f"Unknown karyotype {karyotype}, choose from {', '.join(KARYOTYPES)}")
+        weights[karyotype] = float(weight)
+    return weights
+
+def run(command):
+    subprocess.run(command, shell=True, check=True)
+
+def write_reference(path, rng):
+    with open(path, "w") as f:
+        for name, length in CONTIGS:
+            f.write(f">{name}\n")
+            seq = "".join(rng.choice("ACGT") for _ in range(length))
+            for i in range(0, length, 60):
+                f.write(seq[i:i+60] + "\n")
+    run(f"samtools faidx {path}")
+
+def read_reference(path):
+    seqs, name = {}, None
+    with open(path) as f:
+        for line in f:
+            if line.startswith(">"):
+                name = line[1:].split()[0]
+                seqs[name] = []
+            else:
+                seqs[name].append(line.strip())
+    return {k: "".join(v) for k, v in seqs.items()}
+
+def simulate_reads(rng, karyotype, depth, y_noise):
+    '''Yield (contig, fragment start) for the read pairs of one sample'''
+    x_copies, y_copies = KARYOTYPES[karyotype]
+    for name, length in CONTIGS:
+        if name == "1":
+            start, end, copies = 0, length, 2
+        elif name == "X":
+            start, end, copies = 0, length, x_copies
+        else:
+            start, end = Y_MAPPABLE
+            copies = y_copies if y_copies else y_noise
+        pairs = int(rng.gauss(1, 0.02) * copies * depth * (end - start) / (2 * READ_LENGTH))
+        for _ in range(max(0, pairs)):
+            yield name, rng.randrange(start, end - INSERT)
+
+def write_alignment(path, fmt, reference, seqs, rng, karyotype, depth, y_noise):
+    records = []
+    for i, (contig, start) in enumerate(simulate_reads(rng, karyotype, depth, y_noise)):
+        mate = start + INSERT - READ_LENGTH
+        seq1, seq2 = seqs[contig][start:start+READ_LENGTH], seqs[contig][mate:mate+READ_LENGTH]
+        records.append((contig, start, f"r{i}\t99\t{contig}\t{start+1}\t60\t{READ_LENGTH}M\t=\t{mate+1}\t{INSERT}\t{seq1}\t*"))
+        records.append((contig, mate, f"r{i}\t147\t{contig}\t{mate+1}\t60\t{READ_LENGTH}M\t=\t{start+1}\t{-INSERT}\t{seq2}\t*"))
+    order = {name: i for i, (name, _) in enumerate(CONTIGS)}
+    records.sort(key=lambda r: (order[r[0]], r[1]))
+    sam = path + ".sam"
+    with open(sam, "w") as f:
+        f.write("@HD\tVN:1.6\tSO:coordinate\n")
+        for name, length in CONTIGS:
+            f.write(f"@SQ\tSN:{name}\tLN:{length}\n")
+        f.write("\n".join(r[2] for r in records) + "\n")
+    option = f"-C -T {reference}" if fmt == "CRAM" else "-b"
+    run(f"samtools view {option} -o {path} {sam} && samtools index {path}")
+    os.remove(sam)
+
+def write_vcf(path, samples, karyotypes, rng, sites):
+    '''X chromosome genotypes: one X copy gives homozygous calls, two or more give heterozygous ones'''
+    frequencies = [rng.uniform(0.05, 0.5) for _ in range(sites)]
+    positions = sorted(rng.sample(range(1, CONTIGS[1][1]), sites))
+    with open(path, "w") as f:
+        f.write("##fileformat=VCFv4.2\n")
+        for name, length in CONTIGS:
+            f.write(f"##contig=<ID={name},length={length}>\n")
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples) + "\n")
+        for pos, p in zip(positions, frequencies):
+            gts = []
+            for karyotype in karyotypes:
+                x_copies = KARYOTYPES[karyotype][0]
+                alleles = [int(rng.random() < p) for _ in range(x_copies)]
+                if rng.random() < 0.01:
+                    gts.append("./.")
+                elif x_copies == 1 or len(set(alleles)) == 1:
+                    gts.append(f"{alleles[0]}/{alleles[0]}")
+                else:
+                    gts.append("0/1")
+            f.write(f"X\t{pos}\t.\tA\tG\t50\tPASS\t.\tGT\t" + "\t".join(gts) + "\n")
+    if shutil.which("bgzip") and shutil.which("tabix"):
+        run(f"bgzip -f {path} && tabix -p vcf {path}.gz")
+        return path + ".gz"
+    return path
+
+def generate_cohort(outdir, samples, depth=0.5, mix=DEFAULT_MIX, fmt="BAM", sites=2000, y_noise=0.01, seed=1):
+    '''Write a synthetic cohort to outdir and return the paths of its manifest, VCF, truth table and reference'''
+    rng = random.Random(seed)
+    os.makedirs(outdir+"/alignments", exist_ok=True)
+    reference = outdir+"/reference.fa"
+    if not os.path.isfile(reference):
+        write_reference(reference, rng)
+    seqs = read_reference(reference)
+    weights = parse_mix(mix)
+    karyotypes = rng.choices(list(weights), weights=list(weights.values()), k=samples)
+    ids = [f"S{i:06d}" for i in range(samples)]
+    suffix = "cram" if fmt == "CRAM" else "bam"
+    with open(outdir+"/bam.file", "w") as manifest, open(outdir+"/truth.txt", "w") as truth:
+        truth.write("sampleid\tkaryotype\tsex\n")
+        for sampleid, karyotype in zip(ids, karyotypes):
+            path = os.path.abspath(f"{outdir}/alignments/{sampleid}.{suffix}")
+            write_alignment(path, fmt, reference, seqs, rng, karyotype, depth, y_noise)
+            manifest.write(f"{sampleid} {path}\n")
+            truth.write(f"{sampleid}\t{karyotype}\t{'Male' if KARYOTYPES[karyotype][1] else 'Female'}\n")
+    vcf = write_vcf(outdir+"/cohort.vcf", ids, karyotypes, rng, sites)
+    return {"manifest": outdir+"/bam.file", "vcf": vcf, "truth": outdir+"/truth.txt", "reference": reference}
+
+def main():
+    parser = argparse.ArgumentParser(description = "Generate a synthetic seGMM cohort (alignments, VCF, manifest and truth karyotypes).")
+    parser.add_argument("--output","-o",required = True,help = "Output directory.")
+    parser.add_argument("--samples","-n",required = False,type = int,default = 10,help = "Number of samples. [default: 10]")
+    parser.add_argument("--depth","-d",required = False,type = float,default = 0.5,help = "Read depth per haploid copy. [default: 0.5]")
+    parser.add_argument("--mix","-m",required = False,default = DEFAULT_MIX,help = f"Karyotype weights. [default: {DEFAULT_MIX}]")
+    parser.add_argument("--alignment_format","-a",required = False,choices = ["BAM","CRAM"],default = "BAM",help = "Alignment format. [default: BAM]")
+    parser.add_argument("--sites",required = False,type = int,default = 2000,help = "Number of chrX sites in the VCF. [default: 2000]")
+    parser.add_argument("--y_noise",required = False,type = float,default = 0.01,help = "Relative chrY read density of samples without a Y chromosome (mismapped reads). [default: 0.01]")
+    parser.add_argument("--seed",required = False,type = int,default = 1,help = "Random seed. [default: 1]")
+    args = parser.parse_args()
+    paths = generate_cohort(args.output, args.samples, args.depth, args.mix, args.alignment_format, args.sites, args.y_noise, args.seed)
+    for k, v in paths.items():
+        print(f"{k}\t{v}")
+
+if __name__ == '__main__':
+    main()
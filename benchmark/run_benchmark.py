@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+############################################################################
+# File Name: run_benchmark
+# Description: time every seGMM stage on synthetic cohorts and check accuracy
+############################################################################
+
+import argparse, datetime, json, os, shlex, shutil, subprocess, sys, time
+from pathlib import Path
+
+from generate import DEFAULT_MIX, generate_cohort
+
+# the seGMM of this checkout, not whichever version is installed
+SEGMM_MAIN = Path(__file__).absolute().parent.parent/"code"/"main.py"
+
+def read_table(path):
+    with open(path) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+    return header, rows
+
+def accuracy(result, truth):
+    '''Sex accuracy, {karyotype: (correct, samples)} and the wrong karyotype calls against the generated truth'''
+    header, rows = read_table(result)
+    # seGMM_result.txt has no column name for the sample ids (R write.table layout)
+    predicted = {r[0]: (r[header.index("Predict") + 1], r[header.index("karyotypes") + 1]) for r in rows}
+    _, expected = read_table(truth)
+    sex = sum(predicted.get(i, ("NA", "NA"))[0] == s for i, _, s in expected)
+    karyotypes = {}
+    for i, k, _ in expected:
+        correct, total = karyotypes.get(k, (0, 0))
+        karyotypes[k] = (correct + (predicted.get(i, ("NA", "NA"))[1] == k), total + 1)
+    wrong = [(i, k, predicted.get(i, ("NA", "NA"))[1]) for i, k, _ in expected if predicted.get(i, ("NA", "NA"))[1] != k]
+    return sex / len(expected), karyotypes, wrong
+
+def karyotype_accuracy(karyotypes, names):
+    '''Fraction of correct karyotype calls over the samples of the given karyotypes (None without such samples)'''
+    correct = sum(karyotypes[k][0] for k in names if k in karyotypes)
+    total = sum(karyotypes[k][1] for k in names if k in karyotypes)
+    return correct / total if total else None
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        return ""
+
+def previous_result(results, record):
+    if not os.path.isfile(results):
+        return None
+    keys = ["samples", "depth", "mix", "alignment_format", "backend", "num_threshold"]
+    last = None
+    with open(results) as f:
+        for line in f:
+            entry = json.loads(line)
+            if all(entry.get(k) == record[k] for k in keys):
+                last = entry
+    return last
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark seGMM on synthetic cohorts of several sizes.")
+    parser.add_argument("--scales","-s",required = False,default = "10,1000,10000",help = "Comma separated cohort sizes. [default: 10,1000,10000]")
+    parser.add_argument("--workdir","-w",required = False,default = "benchmark_data",help = "Directory for the generated cohorts and seGMM outputs. Existing cohorts are reused. [default: benchmark_data]")
+    parser.add_argument("--depth","-d",required = False,type = float,default = 0.5,help = "Read depth per haploid copy. [default: 0.5]")
+    parser.add_argument("--mix","-m",required = False,default = DEFAULT_MIX,help = f"Karyotype weights. [default: {DEFAULT_MIX}]")
+    parser.add_argument("--alignment_format","-a",required = False,choices = ["BAM","CRAM"],default = "BAM",help = "Alignment format. [default: BAM]")
+    parser.add_argument("--backend","-b",required = False,choices = ["R","python"],default = "python",help = "GMM backend passed to seGMM. [default: python]")
+    parser.add_argument("--num_threshold","-n",required = False,default = "1",help = "Threads passed to seGMM. [default: 1]")
+    parser.add_argument("--segmm",required = False,default = f"{shlex.quote(sys.executable)} {shlex.quote(str(SEGMM_MAIN))}",help = "Command used to run seGMM. [default: python code/main.py of this checkout]")
+    parser.add_argument("--results","-r",required = False,default = str(Path(__file__).parent/"results.jsonl"),help = "File the results are appended to. [default: benchmark/results.jsonl]")
+    parser.add_argument("--min_accuracy",required = False,type = float,default = 0.95,help = "Fail when the sex accuracy or the karyotype accuracy of the gated karyotypes is below this. [default: 0.95]")
+    parser.add_argument("--gate_karyotypes",required = False,default = "XX,XY",help = "Karyotypes whose calls are held to --min_accuracy; the others are only reported. [default: XX,XY]")
+    args = parser.parse_args()
+
+    failed = False
+    for samples in [int(i) for i in args.scales.split(",")]:
+        cohort = f"{args.workdir}/cohort_{samples}_{args.alignment_format}_{args.depth}"
+        start = time.time()
+        paths = generate_cohort(cohort, samples, args.depth, args.mix, args.alignment_format) if not os.path.isfile(cohort+"/truth.txt") else \
+            {"manifest": cohort+"/bam.file", "vcf": next(f"{cohort}/{i}" for i in ["cohort.vcf.gz", "cohort.vcf"] if os.path.isfile(f"{cohort}/{i}")),
+             "truth": cohort+"/truth.txt", "reference": cohort+"/reference.fa"}
+        generate_seconds = time.time() - start
+
+        outdir = f"{cohort}/seGMM_{args.backend}"
+        if os.path.isdir(outdir):
+            shutil.rmtree(outdir)
+        command = shlex.split(args.segmm) + ["-vcf", paths["vcf"], "-i", paths["manifest"], "-a", args.alignment_format, "-t", "WGS",
+                                             "-o", outdir, "-b", args.backend, "-n", args.num_threshold]
+        if args.alignment_format == "CRAM":
+            command += ["-R", paths["reference"]]
+        start = time.time()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        total_seconds = time.time() - start
+
+        with open(outdir+"/metrics.json") as f:
+            metrics = json.load(f)["run"]
+        sex, karyotypes, wrong = accuracy(outdir+"/seGMM_result.txt", paths["truth"])
+        gated = karyotype_accuracy(karyotypes, args.gate_karyotypes.split(","))
+        record = {"date": datetime.datetime.now().isoformat(timespec="seconds"), "commit": git_commit(), "samples": samples,
+                  "depth": args.depth, "mix": args.mix, "alignment_format": args.alignment_format, "backend": args.backend,
+                  "num_threshold": args.num_threshold, "generate_seconds": round(generate_seconds, 3), "total_seconds": round(total_seconds, 3),
+                  "stages": {k: round(v["wall_seconds"], 3) for k, v in metrics["stages"].items()},
+                  "tools": {k: round(v["wall_seconds"], 3) for k, v in metrics["tools"].items()},
+                  "peak_rss_kb": metrics["peak_rss_kb"], "sex_accuracy": sex,
+                  "karyotype_accuracy": karyotype_accuracy(karyotypes, karyotypes), "gated_karyotype_accuracy": gated,
+                  "karyotypes": {k: {"correct": c, "samples": n} for k, (c, n) in sorted(karyotypes.items())}}
+        last = previous_result(args.results, record)
+        with open(args.results, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+        print(f"== {samples} samples ({args.alignment_format}, depth {args.depth}, backend {args.backend})")
+        print(f"   end-to-end {total_seconds:.2f}s" + (f" (previous {last['total_seconds']:.2f}s at {last['commit']})" if last else ""))
+        for stage, seconds in record["stages"].items():
+            print(f"   {stage:<12} {seconds:.2f}s summed over samples")
+        print(f"   sex accuracy {sex:.4f}, karyotype accuracy {record['karyotype_accuracy']:.4f}")
+        for k, (correct, total) in sorted(karyotypes.items()):
+            print(f"   {k:<4} {correct}/{total} karyotypes called" + (" (gated)" if k in args.gate_karyotypes.split(",") else ""))
+        for sampleid, expected, predicted in wrong[:10]:
+            print(f"   {sampleid}: expected {expected}, predicted {predicted}")
+        if sex < args.min_accuracy or (gated is not None and gated < args.min_accuracy):
+            print(f"   FAILED: sex or {args.gate_karyotypes} karyotype accuracy below {args.min_accuracy}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
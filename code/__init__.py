@@ -1 +1,15 @@
+'''seGMM: gender determination from massively parallel sequencing data.
 
+    import seGMM
+    table = seGMM.extract_features("bam.file", "cohort.vcf.gz", threads=8)
+    result = seGMM.classify(table)
+'''
+
+__all__ = ["extract_features", "classify", "write_result", "FeatureTable"]
+
+def __getattr__(name):
+    # Imported on first use so that `python -m seGMM.main` does not load seGMM.main twice
+    if name in __all__:
+        from . import api
+        return getattr(api, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,52 @@
+############################################################################
+# File Name: api
+# Description: library interface for embedding seGMM without a subprocess
+############################################################################
+
+import os
+
+from . import gmm
+from .cache import FeatureCache
+from .journal import RunJournal
+from .main import collect_features, normalize_SRY, read_manifest
+from .table import FEATURES, FeatureTable
+
+def extract_features(manifest, vcf, features=FEATURES, alignment_format="BAM", fasta=None, quality=30, genome="hg19",
+                     threads=1, fast_index=False, cache=None, journal=None, normalize_sry=False):
+    '''Collect the features of a cohort into a FeatureTable keyed by sample id.
+
+    manifest is a seGMM --input file or a list of (sampleid, alignment) pairs
+    and cache a FeatureCache or the path of its database. With a journal (a
+    RunJournal or the path of its database) samples whose bam/cram cannot be
+    read are recorded and left out instead of raising. With normalize_sry the
+    SRY depth is divided by XYratio, as in the reference files.
+    '''
+    samples = read_manifest(manifest) if isinstance(manifest, (str, os.PathLike)) else (tuple(i) for i in manifest)
+    fasta = str(os.path.realpath(fasta)) if fasta else " "
+    if isinstance(cache, (str, os.PathLike)):
+        cache = FeatureCache(cache)
+    if isinstance(journal, (str, os.PathLike)):
+        journal = RunJournal(journal)
+    table = collect_features(list(features), vcf, samples, alignment_format, fasta, quality, threads, genome, fast_index, cache, journal)
+    return normalize_SRY(table) if normalize_sry else table
+
+def classify(table, threshold=0.1, model=None, reference=None):
+    '''Call sex and karyotype for the samples of a FeatureTable.
+
+    The GMM is fitted on the table, stacked under a reference FeatureTable
+    (e.g. FeatureTable.read("1000G.WES.txt")) when one is given, or the samples
+    are scored against a frozen model from `seGMM fit-reference` (a dict or
+    the path of its JSON file). Returns the table with Predict, karyotypes and
+    uncertainty columns added.
+    '''
+    if isinstance(model, (str, os.PathLike)):
+        model = gmm.load_model(model)
+    if reference is not None:
+        table = reference.concat(table)
+    result, _ = gmm.classify_table(table, float(threshold), model)
+    return result
+
+def write_result(result, outfile):
+    '''Write a classify() result as seGMM_result.txt'''
+    names = [i for i in result.names if i not in ["Predict", "karyotypes", "uncertainty"]]
+    gmm.write_result(outfile, result.ids, names, result.matrix(names), result["Predict"], result["karyotypes"])
@@ -0,0 +1,51 @@
+############################################################################
+# File Name: cache
+# Description: persistent per-sample feature store shared between runs
+############################################################################
+
+import json, os, sqlite3, threading
+
+class FeatureCache:
+    '''Per-sample features stored in one SQLite file.
+
+    Entries are keyed by the input file path, the feature and the sample id,
+    and are only returned while the file size, mtime and the parameters used
+    to compute them (MAPQ, genome, ...) are unchanged, so stale entries are
+    recomputed and replaced instead of reused.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS features (
+                path TEXT, feature TEXT, sampleid TEXT, size INTEGER, mtime INTEGER,
+                params TEXT, value TEXT, PRIMARY KEY (path, feature, sampleid))''')
+
+    @staticmethod
+    def identity(path):
+        stat = os.stat(path)
+        return os.path.realpath(path), stat.st_size, stat.st_mtime_ns
+
+    def get(self, path, feature, sampleid, params=""):
+        '''Return the cached value or None when it is missing or stale'''
+        path, size, mtime = self.identity(path)
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, params, value FROM features WHERE path=? AND feature=? AND sampleid=?",
+                                  (path, feature, sampleid)).fetchone()
+        if row is None or tuple(row[:3]) != (size, mtime, params):
+            return None
+        return json.loads(row[3])
+
+    def put(self, path, feature, sampleid, value, params=""):
+        self.put_many(path, feature, [(sampleid, value)], params)
+
+    def put_many(self, path, feature, values, params=""):
+        path, size, mtime = self.identity(path)
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(path, feature, sampleid, size, mtime, params, json.dumps(value)) for sampleid, value in values])
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,372 @@
+############################################################################
+# File Name: gmm
+# Description: NumPy port of script/seGMM.r (mclust Mclust(G=2) + karyotype rules)
+############################################################################
+
+import json
+
+import numpy as np
+
+# mclust's default multivariate models, in the order Mclust() tries them
+MODELS = ["EII", "VII", "EEI", "VEI", "EVI", "VVI", "EEE", "VEE", "EVE", "VVE", "EEV", "VEV", "EVV", "VVV"]
+TOL = 1e-5
+MAX_ITER = 10000
+INNER_ITER = 100
+
+def n_var_params(model, d, G):
+    '''Number of covariance parameters, as mclust's nVarParams'''
+    return {
+        "EII": 1,
+        "VII": G,
+        "EEI": d,
+        "VEI": G + (d - 1),
+        "EVI": 1 + G * (d - 1),
+        "VVI": G * d,
+        "EEE": d * (d + 1) // 2,
+        "VEE": G + d * (d + 1) // 2 - 1,
+        "EVE": 1 + G * (d - 1) + d * (d - 1) // 2,
+        "VVE": G + G * (d - 1) + d * (d - 1) // 2,
+        "EEV": 1 + (d - 1) + G * d * (d - 1) // 2,
+        "VEV": G + (d - 1) + G * d * (d - 1) // 2,
+        "EVV": 1 + G * (d * (d + 1) // 2 - 1),
+        "VVV": G * d * (d + 1) // 2,
+    }[model]
+
+def _normalize(a):
+    '''Scale a positive diagonal (vector) or matrix to determinant 1, returning (scaled, det^(1/d))'''
+    d = a.shape[-1]
+    det = np.prod(a) if a.ndim == 1 else np.linalg.det(a)
+    if det <= 0:
+        raise np.linalg.LinAlgError("singular covariance")
+    scale = det ** (1 / d)
+    return a / scale, scale
+
+def _eigen(w):
+    '''Eigen-decomposition with eigenvalues in decreasing order'''
+    values, vectors = np.linalg.eigh(w)
+    return values[::-1], vectors[:, ::-1]
+
+def _common_orientation(W, shapes, volumes):
+    '''MM update of the common eigenvector matrix D for the *VE models (Browne & McNicholas, 2014)'''
+    d = W.shape[1]
+    D = _eigen(W.sum(axis=0))[1]
+    alpha = [np.linalg.eigvalsh(w)[-1] / v for w, v in zip(W, volumes)]
+    for _ in range(INNER_ITER):
+        F = sum(np.diag(1 / a) @ D.T @ (w / v) - al * np.diag(1 / a) @ D.T for w, a, v, al in zip(W, shapes, volumes, alpha))
+        P, _, Qt = np.linalg.svd(F)
+        new = Qt.T @ P.T
+        if np.allclose(new, D, atol=TOL):
+            return new
+        D = new
+    return D
+
+def covariances(model, W, nk, n):
+    '''M-step for the covariance matrices of model given the weighted scatter matrices W'''
+    G, d, _ = W.shape
+    eye = np.eye(d)
+    diag = np.array([np.diag(w) for w in W])
+    if model == "EII":
+        return np.array([np.trace(W.sum(axis=0)) / (n * d) * eye] * G)
+    if model == "VII":
+        return np.array([np.trace(w) / (k * d) * eye for w, k in zip(W, nk)])
+    if model == "EEI":
+        return np.array([np.diag(diag.sum(axis=0) / n)] * G)
+    if model == "VEI":
+        A = _normalize(diag.sum(axis=0))[0]
+        for _ in range(INNER_ITER):
+            lam = np.array([np.sum(b / A) / (k * d) for b, k in zip(diag, nk)])
+            new = _normalize((diag / lam[:, None]).sum(axis=0))[0]
+            if np.allclose(new, A, atol=TOL):
+                break
+            A = new
+        return np.array([l * np.diag(A) for l in lam])
+    if model == "EVI":
+        shapes, scales = zip(*(_normalize(b) for b in diag))
+        lam = sum(scales) / n
+        return np.array([lam * np.diag(a) for a in shapes])
+    if model == "VVI":
+        return np.array([np.diag(b / k) for b, k in zip(diag, nk)])
+    if model == "EEE":
+        return np.array([W.sum(axis=0) / n] * G)
+    if model == "VEE":
+        C = _normalize(W.sum(axis=0))[0]
+        for _ in range(INNER_ITER):
+            inv = np.linalg.inv(C)
+            lam = np.array([np.trace(w @ inv) / (k * d) for w, k in zip(W, nk)])
+            new = _normalize((W / lam[:, None, None]).sum(axis=0))[0]
+            if np.allclose(new, C, atol=TOL):
+                break
+            C = new
+        return np.array([l * C for l in lam])
+    if model in ["EVE", "VVE"]:
+        D = _eigen(W.sum(axis=0))[1]
+        lam = np.ones(G)
+        for _ in range(INNER_ITER):
+            B = np.array([np.diag(D.T @ w @ D) for w in W])
+            shapes = np.array([_normalize(b)[0] for b in B])
+            if model == "EVE":
+                lam = np.repeat(sum(np.sum(b / a) for b, a in zip(B, shapes)) / (n * d), G)
+            else:
+                lam = np.array([np.sum(b / a) / (k * d) for b, a, k in zip(B, shapes, nk)])
+            new = _common_orientation(W, shapes, lam)
+            if np.allclose(np.abs(new), np.abs(D), atol=TOL):
+                break
+            D = new
+        return np.array([l * D @ np.diag(a) @ D.T for l, a in zip(lam, shapes)])
+    if model in ["EEV", "VEV"]:
+        values, vectors = zip(*(_eigen(w) for w in W))
+        values = np.array(values)
+        A, scale = _normalize(values.sum(axis=0))
+        lam = np.repeat(scale / n, G)
+        if model == "VEV":
+            for _ in range(INNER_ITER):
+                lam = np.array([np.sum(o / A) / (k * d) for o, k in zip(values, nk)])
+                new = _normalize((values / lam[:, None]).sum(axis=0))[0]
+                if np.allclose(new, A, atol=TOL):
+                    break
+                A = new
+        return np.array([l * v @ np.diag(A) @ v.T for l, v in zip(lam, vectors)])
+    if model == "EVV":
+        shapes, scales = zip(*(_normalize(w) for w in W))
+        lam = sum(scales) / n
+        return np.array([lam * c for c in shapes])
+    if model == "VVV":
+        return W / nk[:, None, None]
+    raise ValueError(f"Unknown mclust model {model}")
+
+def log_density(X, mean, sigma):
+    '''Log density of a multivariate normal for every row of X'''
+    L = np.linalg.cholesky(sigma)
+    z = np.linalg.solve(L, (X - mean).T)
+    return -0.5 * (np.sum(z ** 2, axis=0) + X.shape[1] * np.log(2 * np.pi)) - np.sum(np.log(np.diag(L)))
+
+def estep(X, pro, mean, sigma):
+    '''Return (responsibilities, log-likelihood)'''
+    logp = np.column_stack([np.log(p) + log_density(X, m, s) for p, m, s in zip(pro, mean, sigma)])
+    top = logp.max(axis=1, keepdims=True)
+    lse = top + np.log(np.exp(logp - top).sum(axis=1, keepdims=True))
+    return np.exp(logp - lse), float(lse.sum())
+
+def mstep(X, z, model):
+    n = X.shape[0]
+    nk = z.sum(axis=0)
+    if np.any(nk < 1e-8):
+        raise np.linalg.LinAlgError("empty component")
+    mean = (z.T @ X) / nk[:, None]
+    W = np.array([(z[:, k, None] * (X - mean[k])).T @ (X - mean[k]) for k in range(z.shape[1])])
+    return nk / n, mean, covariances(model, W, nk, n)
+
+def initial_z(X, G=2):
+    '''Deterministic hard partition used to start EM.
+
+    mclust starts from model-based hierarchical clustering; here k-means seeded
+    at the extremes of the first principal component plays that role.
+    '''
+    pc = np.linalg.svd(X - X.mean(axis=0), full_matrices=False)[2][0]
+    score = X @ pc
+    centers = X[np.argsort(score)[np.linspace(0, len(X) - 1, G).astype(int)]]
+    labels = None
+    for _ in range(MAX_ITER):
+        new = np.argmin(((X[:, None, :] - centers[None]) ** 2).sum(axis=2), axis=1)
+        if labels is not None and np.array_equal(new, labels):
+            break
+        labels = new
+        centers = np.array([X[labels == k].mean(axis=0) if np.any(labels == k) else centers[k] for k in range(G)])
+    return np.eye(G)[labels]
+
+def fit_model(X, model, z):
+    '''Run EM for one mclust model and return its fitted parameters and BIC'''
+    n, d = X.shape
+    G = z.shape[1]
+    loglik = None
+    for _ in range(MAX_ITER):
+        pro, mean, sigma = mstep(X, z, model)
+        z, new = estep(X, pro, mean, sigma)
+        if loglik is not None and abs(new - loglik) / (1 + abs(new)) < TOL:
+            loglik = new
+            break
+        loglik = new
+    npar = G * d + (G - 1) + n_var_params(model, d, G)
+    return {"model": model, "loglik": loglik, "bic": 2 * loglik - npar * np.log(n),
+            "pro": pro, "mean": mean, "sigma": sigma, "z": z}
+
+def mclust(X, G=2, models=MODELS):
+    '''Fit every model with G components and keep the one with the highest BIC, like Mclust(X, G=G)'''
+    X = np.asarray(X, dtype=float)
+    z0 = initial_z(X, G)
+    best = None
+    for model in models:
+        try:
+            fit = fit_model(X, model, z0)
+        except (np.linalg.LinAlgError, FloatingPointError, ValueError):
+            continue
+        if np.isfinite(fit["bic"]) and (best is None or fit["bic"] > best["bic"]):
+            best = fit
+    if best is None:
+        raise RuntimeError("None of the mclust models could be fitted to the features")
+    best["classification"] = best["z"].argmax(axis=1) + 1
+    best["uncertainty"] = 1 - best["z"].max(axis=1)
+    return best
+
+def scale(X):
+    '''Centre and scale columns like R's scale()'''
+    center = X.mean(axis=0)
+    sd = X.std(axis=0, ddof=1)
+    sd[sd == 0] = 1
+    return (X - center) / sd, center, sd
+
+def assign_sex(names, X, classification):
+    '''Label the two clusters Male/Female from the first informative feature, as seGMM.r does'''
+    for feature in ["SRY", "Xmap", "Ymap", "XH", "XYratio"]:
+        if feature in names:
+            col = X[:, names.index(feature)]
+            first_higher = col[classification == 1].mean() > col[classification == 2].mean()
+            male = 1 if first_higher == (feature in ["SRY", "Ymap"]) else 2
+            return np.where(classification == male, "Male", "Female")
+    return np.full(len(X), "NA", dtype=object)
+
+def karyotype_bounds(names, X, predict):
+    '''Mean and sd of Xmap/Ymap in the XX and XY groups, or None when seGMM.r would skip the karyotype rules'''
+    if not ("Xmap" in names and "Ymap" in names):
+        return None
+    if np.sum(predict == "Female") <= 3 or np.sum(predict == "Male") <= 3:
+        return None
+    xmap, ymap = X[:, names.index("Xmap")], X[:, names.index("Ymap")]
+    bounds = {}
+    for sex, karyotype in [("Female", "XX"), ("Male", "XY")]:
+        mask = predict == sex
+        bounds[karyotype] = {
+            "Xmap": (float(xmap[mask].mean()), float(xmap[mask].std(ddof=1))),
+            "Ymap": (float(ymap[mask].mean()), float(ymap[mask].std(ddof=1))),
+        }
+    return bounds
+
+def karyotypes(names, X, predict, bounds):
+    '''Apply the mean +/- 3 SD karyotype rules of seGMM.r'''
+    karyotype = np.where(predict == "Male", "XY", np.where(predict == "Female", "XX", "NA")).astype(object)
+    if bounds is None:
+        return karyotype
+    xmap, ymap = X[:, names.index("Xmap")], X[:, names.index("Ymap")]
+    (mfx, sfx), (mfy, sfy) = bounds["XX"]["Xmap"], bounds["XX"]["Ymap"]
+    (mmx, smx), (mmy, smy) = bounds["XY"]["Xmap"], bounds["XY"]["Ymap"]
+    for i, (x, y, sex) in enumerate(zip(xmap, ymap, predict)):
+        if sex == "Male":
+            x_normal = mmx - 3 * smx < x < mmx + 3 * smx
+            y_normal = mmy - 3 * smy < y < mmy + 3 * smy
+            if x_normal and y_normal:
+                karyotype[i] = "XY"
+            elif x_normal and y > 2 * mmy:
+                karyotype[i] = "XYY"
+            elif x > 2 * mmx and y_normal:
+                karyotype[i] = "XXY"
+            elif x < mmx / 5 and y_normal:
+                karyotype[i] = "Y"
+        elif sex == "Female":
+            x_normal = mfx - 3 * sfx < x < mfx + 3 * sfx
+            y_normal = mfy - 3 * sfy < y < mfy + 3 * sfy
+            if x_normal and y_normal:
+                karyotype[i] = "XX"
+            elif y > 3 * mfy and x_normal:
+                karyotype[i] = "XXY"
+            elif x > 2 * mfx and y_normal:
+                karyotype[i] = "XXX"
+            elif x < 0.5 * mfx and y_normal:
+                karyotype[i] = "X"
+    return karyotype
+
+def classify(names, X, threshold):
+    '''Cluster the features and call sex and karyotype for every sample.
+
+    Returns (predict, karyotype, uncertainty, fit) with the same calls that
+    script/seGMM.r makes from mclust.
+    '''
+    X = np.asarray(X, dtype=float)
+    fit = mclust(scale(X)[0], G=2)
+    predict = assign_sex(names, X, fit["classification"])
+    karyotype = karyotypes(names, X, predict, karyotype_bounds(names, X, predict))
+    outliers = fit["uncertainty"] >= threshold
+    predict = np.where(outliers, "NA", predict)
+    karyotype = np.where(outliers, "NA", karyotype)
+    return predict, karyotype, fit["uncertainty"], fit
+
+def read_features(feature_file):
+    '''Read a feature table (sampleid + feature columns) into (ids, names, matrix)'''
+    with open(feature_file) as f:
+        names = f.readline().rstrip("\n").split("\t")[1:]
+        rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+    return [i[0] for i in rows], names, np.array([[float(j) for j in i[1:]] for i in rows])
+
+def write_result(outfile, ids, names, X, predict, karyotype):
+    '''Write seGMM_result.txt in the layout of R's write.table (no header for the row names)'''
+    with open(outfile, "w") as f:
+        f.write("\t".join(names + ["Predict", "karyotypes"]) + "\n")
+        for sampleid, row, p, k in zip(ids, X, predict, karyotype):
+            f.write("\t".join([sampleid] + [format(v, ".15g") for v in row] + [p, k]) + "\n")
+
+def classify_table(table, threshold, model=None):
+    '''Classify the samples of a FeatureTable and return (result, fit).
+
+    result is a copy of the table with Predict, karyotypes and uncertainty
+    columns added. The GMM is fitted on the table itself, or the samples are
+    scored against a frozen reference model when one is given.
+    '''
+    if model is None:
+        predict, karyotype, uncertainty, fit = classify(table.names, table.matrix(), threshold)
+    else:
+        predict, karyotype, uncertainty = score(model, table.names, table.matrix(), threshold)
+        fit = model
+    result = table.select()
+    result["Predict"] = predict
+    result["karyotypes"] = karyotype
+    result["uncertainty"] = uncertainty
+    return result, fit
+
+def fit_reference(names, X):
+    '''Fit the GMM once on a reference panel and freeze everything needed to score new samples'''
+    X = np.asarray(X, dtype=float)
+    Xs, center, sd = scale(X)
+    fit = mclust(Xs, G=2)
+    predict = assign_sex(names, X, fit["classification"])
+    sex = [str(predict[fit["classification"] == k + 1][0]) if np.any(fit["classification"] == k + 1) else "NA" for k in range(2)]
+    return {
+        "features": list(names),
+        "center": center.tolist(),
+        "scale": sd.tolist(),
+        "model": fit["model"],
+        "bic": float(fit["bic"]),
+        "pro": fit["pro"].tolist(),
+        "mean": fit["mean"].tolist(),
+        "sigma": fit["sigma"].tolist(),
+        "sex": sex,
+        "bounds": karyotype_bounds(names, X, predict),
+        "n_reference": len(X),
+    }
+
+def score(model, names, X, threshold):
+    '''Classify samples against a frozen reference model without refitting.
+
+    Returns (predict, karyotype, uncertainty) like classify(); X is reordered
+    to the model's feature order and must contain exactly the same features.
+    '''
+    if sorted(names) != sorted(model["features"]):
+        raise ValueError(f"The features {', '.join(names)} do not match the reference model features {', '.join(model['features'])}")
+    X = np.asarray(X, dtype=float)[:, [names.index(i) for i in model["features"]]]
+    Xs = (X - np.array(model["center"])) / np.array(model["scale"])
+    z, _ = estep(Xs, np.array(model["pro"]), np.array(model["mean"]), np.array(model["sigma"]))
+    predict = np.array(model["sex"], dtype=object)[z.argmax(axis=1)]
+    karyotype = karyotypes(model["features"], X, predict, model["bounds"])
+    uncertainty = 1 - z.max(axis=1)
+    outliers = uncertainty >= threshold
+    return np.where(outliers, "NA", predict), np.where(outliers, "NA", karyotype), uncertainty
+
+def save_model(model, path):
+    with open(path, "w") as f:
+        json.dump(model, f, indent=1)
+
+def load_model(path):
+    with open(path) as f:
+        model = json.load(f)
+    missing = {"features", "center", "scale", "pro", "mean", "sigma", "sex", "bounds"} - set(model)
+    if missing:
+        raise ValueError(f"{path} is not a seGMM reference model (missing {', '.join(sorted(missing))})")
+    return model
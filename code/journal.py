@@ -0,0 +1,59 @@
+############################################################################
+# File Name: journal
+# Description: per-sample stage journal of a run, for resuming and error reports
+############################################################################
+
+import sqlite3, threading, time
+
+class RunJournal:
+    '''Completion or failure of every stage x sample of the runs in one output directory.
+
+    Every record is committed on its own, so a killed run keeps all the
+    stages it finished. The feature values themselves live in the
+    FeatureCache, so a restart using the same cache only recomputes
+    unfinished or failed stages.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            with self.db:
+                self.db.execute('''CREATE TABLE IF NOT EXISTS stages (
+                    stage TEXT, sampleid TEXT, status TEXT, error TEXT, updated REAL,
+                    PRIMARY KEY (stage, sampleid))''')
+
+    def record(self, stage, sampleid, status, error=""):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)", (stage, sampleid, status, error, time.time()))
+
+    def done(self, stage, sampleid):
+        self.record(stage, sampleid, "done")
+
+    def fail(self, stage, sampleid, error):
+        self.record(stage, sampleid, "failed", error)
+
+    def summary(self):
+        '''{status: number of stage x sample records}'''
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM stages GROUP BY status").fetchall())
+
+    def failed(self):
+        '''(sampleid, stage, error) of the stages whose last attempt failed'''
+        with self.lock:
+            return self.db.execute("SELECT sampleid, stage, error FROM stages WHERE status='failed' ORDER BY sampleid, stage").fetchall()
+
+    def report(self, outfile):
+        '''Write the failed samples to outfile (sampleid, stage, error) and return how many there are'''
+        failed = self.failed()
+        with open(outfile, "w") as f:
+            f.write("sampleid\tstage\terror\n")
+            for sampleid, stage, error in failed:
+                f.write(f"{sampleid}\t{stage}\t{' '.join(error.split())}\n")
+        return len({i[0] for i in failed})
+
+    def close(self):
+        self.db.close()
@@ -6,10 +6,43 @@
 # Description: a tool to infer gender from massively parallel sequencing data
 ############################################################################
 
-import time, os, re, sys, argparse, traceback,subprocess
-from functools import reduce
+import time, os, re, sys, argparse, traceback,subprocess, tempfile, gzip, shutil, shlex, sqlite3, json
+from collections import Counter
+from functools import partial, reduce
+from itertools import islice
 from pathlib import Path
 
+import numpy as np
+
+if __package__:
+    from . import gmm
+    from .cache import FeatureCache
+    from .journal import RunJournal
+    from .metrics import METRICS
+    from .scheduler import Pipeline
+    from .table import FeatureTable
+else:
+    # run as a script (python code/main.py), with this directory on sys.path
+    import gmm
+    from cache import FeatureCache
+    from journal import RunJournal
+    from metrics import METRICS
+    from scheduler import Pipeline
+    from table import FeatureTable
+
+X_CONTIGS = ["X", "chrX"]
+X_CONTIGS_BYTES = [i.encode() for i in X_CONTIGS]
+XH_CHUNK_SIZE = 5000000
+# X records between two checkpoints of the XH counts in the feature cache
+XH_CHECKPOINT = 100000
+GT_RE = re.compile(r"\t([^\t:]*)")
+CIGAR_RE = re.compile(r"(\d+)([MIDNSHP=X])")
+# htslib required_fields masks: FLAG|RNAME|MAPQ for counting, plus POS|CIGAR for depth, so CRAM
+# records are decoded without reconstructing their sequence from the reference
+COUNT_FIELDS = 0x16
+DEPTH_FIELDS = 0x3e
+MANIFEST_BATCH = 1000
+
 def sec_to_str(t):
     '''Convert seconds to days:hours:minutes:seconds'''
     [d, h, m, s, n] = reduce(lambda ll, b : divmod(ll[0], b) + ll[1:], [(t, 1), 60, 60, 24])
@@ -24,139 +57,715 @@ def sec_to_str(t):
     f += f'{s}s'
     return f
 
+class CommandError(RuntimeError):
+    '''An external command exited with an error'''
+
+    def __init__(self, command, message):
+        super().__init__(f"An error occured when running: '{command}'\n{message}")
+        self.command = command
+
 def runcmd(command):
     try:
         new_env = dict(os.environ)
         new_env['LC_ALL'] = 'C'
-        return_info = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=new_env)
-        error_code = bool(return_info.returncode)
-        message = return_info.stdout.decode()
-    except Exception as e:
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=new_env)
+        message = proc.stdout.read().decode()
+        proc.stdout.close()
+        error_code = bool(METRICS.wait(proc, command, start))
+    except OSError as e:
         error_code = True
-        message = e
-    finally:
-        if error_code:
-            print(f"An error occured when running: '{command}'")
-            print("Please check parameters!")
-            print(message)
-            sys.exit()
-
-def collect_XH(input_vcf,outdir):
-    print(">> Collected feature of X chromosome heterozygosity")
-    cmd = "plink --vcf " + input_vcf + " --make-bed --out " + outdir+"/plink"
-    runcmd(cmd)
-    cmd = "plink --bfile " + outdir+"/plink"+ " --chr X --recode --out " + outdir+"/plink.X"
-    runcmd(cmd)
-    pedfile=outdir+"/plink.X.ped"
-    outfile=outdir+"/XH.txt"
-    if os.path.isfile(outfile):
-        cmd="rm "+outfile
-        runcmd(cmd)
-    XH_list=[]
-    with open(outfile,'a+')as xh:
-        with open(pedfile) as f:
-            line=f.readline()
-            while line:
-                lines=line.rstrip("\n").split(" ")
-                het=0
-                hom=0
-                missing=0
-                all_num=0
-                for i in range(0,int((len(lines)-6)/2)):
-                    if lines[i*2+4]!=lines[2*i+5]:
-                        het+=1
-                        all_num+=1
-                    elif lines[i*2+4]==0:
-                        missing+=1
-                        all_num+=1
-                    else:
-                        hom+=1
-                        all_num+=1
-                if all_num!=missing:
-                    xh.write(str(lines[0])+'\t'+str(het/(all_num-missing))+'\n')
-                else:
-                    xh.write(str(lines[0])+'\t'+float(0)+'\n')
-                line=f.readline()
-        f.close()
-    xh.close()
-    cmd="cat "+ outdir +"/XH.txt "+"| sort -n -k 1 >"+ outdir+"/XH.sorted.txt"
-    runcmd(cmd)
-    print(f'    Finish generate features of X chromosome heterozygosity at {time.ctime()} \n')
+        message = str(e)
+    if error_code:
+        raise CommandError(command, message)
 
-def collect_map(bamfile, fill_type, fasta, quality, num_threshold, outdir, regions=list()):
-    if regions:
-        basename = f"{regions[0]}map"
-    else:
-        basename = "total"
+def streamcmd(command):
+    '''Run a shell pipeline and yield its standard output line by line, raising CommandError when it fails'''
+    new_env = dict(os.environ)
+    new_env['LC_ALL'] = 'C'
+    with tempfile.TemporaryFile() as err:
+        start = time.perf_counter()
+        proc = subprocess.Popen(f"set -o pipefail; {command}", shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=err, env=new_env)
+        yield from proc.stdout
+        proc.stdout.close()
+        if METRICS.wait(proc, command, start):
+            err.seek(0)
+            raise CommandError(command, err.read().decode())
 
-    print(f">> Collected feature of {basename} mapping rate")
-    if not os.path.exists(outdir+"/"+"Read_stat"):
-        os.makedirs(outdir+"/"+"Read_stat")
+def read_manifest(bamfile):
+    '''Yield (sampleid, path) pairs from the input file of bam/cram files'''
+    with open(bamfile) as f:
+        for line in f:
+            lines = line.split()
+            if len(lines) >= 2:
+                yield lines[0], lines[1]
 
-    option = ""
+def check_fasta(fill_type, fasta):
     if fill_type == "CRAM":
         if fasta == " ":
             sys.exit('Error, the fasta file for use with CRAM files is empty, please use --reference_fasta or -R!')
         elif not os.path.isfile(fasta):
             sys.exit('Error, the input reference fasta file is not exist, please check that you have provided the correct path!')
-        option = f"-T {fasta}"
-    
-    cmd = f'''cat {bamfile} | awk '{{print $1"\\n"$2}}' | parallel -j {num_threshold} --max-args 2 samtools view -@ 10 -bh -q {quality} {option} {{2}} {" ".join(regions)} \\| samtools flagstat -@ 10 - \\>  {outdir}\\/Read_stat\\/{{1}}.{basename}.stat'''
-    runcmd(cmd)
-    cmd = f'''cat {bamfile} | awk '{{print $1}}' | while read id; do cat {outdir}/Read_stat/$id.{basename}.stat | awk 'BEGIN{{OFS="\\t"}}NR==9{{print "'$id'",$1}}' ;done | sort -n -k 1 > {outdir}/Read_stat/{basename}.txt'''
-    runcmd(cmd)
-
-    if basename != "total":
-        cmd = f'''join {outdir}/Read_stat/{basename}.txt {outdir}/Read_stat/total.txt | awk 'BEGIN{{OFS="\\t"}}{{print $1,$2/$3}}' > {outdir}/{basename}.txt'''
-        runcmd(cmd)
-
-    print(f'    Finish generate features of {basename} mapping rate at {time.ctime()} \n')
-
-
-def collect_SRY(bamfile,fill_type,fasta,quality,genome_version,outdir):
-    print(">> Collected feature of mean depth of SRY gene")
-    if not os.path.exists(outdir+"/"+"SRY"):
-        os.makedirs(outdir+"/"+"SRY")
-    if fill_type == "BAM": 
-        cmd="cat " + bamfile + ''' | awk '{print $1,$2}' | while read id dir; do mosdepth -t 4 -Q ''' + quality + " -b " + str(Path(__file__).absolute().parent)+"/data/SRY_"+ genome_version + ".bed -n "+ outdir+"/"+"SRY/$id $dir; done"
-        runcmd(cmd)
-        cmd="cat "+bamfile+''' | awk '{print $1}' | while read id; do cat '''+outdir+"/SRY/$id.mosdepth.summary.txt | "+'''awk 'BEGIN{OFS="\\t"}NR==2{out1=$4}NR==3{out2=$4}END{if(out2!=0){print "'$id'",out2}else if(out1!=0){print "'$id'",out1}else{print "'$id'",0}}'; done | sort -n -k 1 >''' + outdir+"/SRY.txt"
-        runcmd(cmd)
-    elif fill_type == "CRAM":
-        if fasta == " ":
-            sys.exit('Error, the fasta file for use with CRAM files is empty, please use --reference_fasta or -R!')
-        elif not os.path.isfile(fasta):
-            sys.exit('Error, the input reference fasta file is not exist, please check that you have provided the correct path!')
+
+def read_contigs(alignment):
+    '''Set of the contig names (SN of the @SQ lines) of a bam/cram header'''
+    contigs = set()
+    for line in streamcmd(f"samtools view -H {shlex.quote(alignment)}"):
+        if line.startswith(b"@SQ"):
+            contigs.update(i[3:].decode() for i in line.rstrip(b"\n").split(b"\t")[1:] if i.startswith(b"SN:"))
+    return contigs
+
+def decode_option(fill_type, fasta, fields):
+    '''samtools view options that decode only the given fields of a CRAM file.
+
+    None of the fields seGMM reads needs the sequence, so htslib does not
+    fetch reference slices and -T costs no more than opening the fasta index.
+    '''
+    if fill_type != "CRAM":
+        return ""
+    return f"--input-fmt-option required_fields={fields:#x} -T {shlex.quote(fasta)}"
+
+def count_reads(alignment, fill_type, fasta, quality):
+    '''Count reads per contig in a single pass over a bam/cram file.
+
+    Reads are filtered like the QC-passed "properly paired" line of
+    `samtools view -q quality | samtools flagstat`, so the total, X and Y
+    counts all come from one decoding pass instead of one pass per feature.
+    '''
+    option = decode_option(fill_type, fasta, COUNT_FIELDS)
+    cmd = f"samtools view -q {int(quality)} -f 3 -F 0xB04 {option} {shlex.quote(alignment)} | cut -f 3"
+    counts = Counter(streamcmd(cmd))
+    return {contig.decode().rstrip("\n"): num for contig, num in counts.items()}
+
+def index_counts(alignment, fill_type):
+    '''Read per-contig mapped counts from the bam index (samtools idxstats).
+
+    Returns None when the index is missing, unreadable (e.g. stale or
+    truncated) or carries no statistics (e.g. a .crai index), so the caller
+    can fall back to counting reads.
+    '''
+    if fill_type != "BAM":
+        return None
+    if not any(os.path.isfile(i) for i in [alignment+".bai", re.sub(r"\.bam$", ".bai", alignment), alignment+".csi"]):
+        return None
+    contigs = {}
+    try:
+        for line in streamcmd(f"samtools idxstats {shlex.quote(alignment)}"):
+            lines = line.decode().rstrip("\n").split("\t")
+            if lines[0] != "*":
+                contigs[lines[0]] = int(lines[2])
+    except (CommandError, ValueError, IndexError) as e:
+        print(f"Warning, the index statistics of {alignment} cannot be read, its reads are counted instead: {str(e).splitlines()[0]}")
+        return None
+    if sum(contigs.values()) == 0:
+        return None
+    return contigs
+
+def sex_counts(contigs):
+    '''Reduce per-contig counts to (total, X, Y)'''
+    total = sum(contigs.values())
+    x = contigs.get("X", 0) + contigs.get("chrX", 0)
+    y = contigs.get("Y", 0) + contigs.get("chrY", 0)
+    return total, x, y
+
+def read_vcf_X(input_vcf):
+    '''Yield the sample ids and then the X chromosome records of a VCF file.
+
+    When the VCF is bgzipped and indexed (.tbi/.csi) only the X chromosome is
+    read through tabix, otherwise the file is streamed and other chromosomes
+    are skipped without being parsed.
+    '''
+    indexed = any(os.path.isfile(input_vcf+i) for i in [".tbi", ".csi"]) and shutil.which("tabix")
+    if indexed:
+        for line in streamcmd(f"tabix -H {shlex.quote(input_vcf)}"):
+            if line.startswith(b"#CHROM"):
+                yield line.decode().rstrip("\n").split("\t")[9:]
+        contigs = [i.decode().rstrip("\n") for i in streamcmd(f"tabix -l {shlex.quote(input_vcf)}")]
+        regions = " ".join(shlex.quote(i) for i in contigs if i in X_CONTIGS)
+        if regions:
+            yield from streamcmd(f"tabix {shlex.quote(input_vcf)} {regions}")
+        return
+    with open(input_vcf, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    with (gzip.open(input_vcf, "rb") if gzipped else open(input_vcf, "rb")) as f:
+        for line in f:
+            if line.startswith(b"#CHROM"):
+                yield line.decode().rstrip("\n").split("\t")[9:]
+            elif line.split(b"\t", 1)[0] in X_CONTIGS_BYTES:
+                yield line
+
+def genotype_code(gt):
+    '''Return (het, called) for a GT string, treating alleles other than REF and the first ALT as missing like plink'''
+    alleles = re.split(r"[/|]", gt)
+    if any(i not in ("0", "1") for i in alleles):
+        return 0, 0
+    return int(len(set(alleles)) > 1), 1
+
+def count_XH(input_vcf, chunk_size=XH_CHUNK_SIZE, shard=(0, 1), cache=None):
+    '''Count heterozygous and called X chromosome genotypes per sample.
+
+    Genotypes are decoded into a sites x samples matrix of about `chunk_size`
+    cells at a time, so memory stays bounded whatever the size of the VCF.
+    With shard=(i, N) only every N-th X record starting at the i-th is used.
+    With a cache the running counts are checkpointed every XH_CHECKPOINT X
+    records (and at the end), keyed by the number of records read, and a
+    later count of the unchanged VCF resumes from the last checkpoint.
+    '''
+    records = read_vcf_X(input_vcf)
+    samples = next(records, None)
+    if samples is None:
+        sys.exit('Error, the input vcf file has no #CHROM header line!')
+    het = np.zeros(len(samples), dtype=np.int64)
+    called = np.zeros(len(samples), dtype=np.int64)
+    sites = max(1, chunk_size // max(1, len(samples)))
+    key = f"{shard[0]}/{shard[1]}"
+    checkpoint = cache.get(input_vcf, "XH.checkpoint", key) if cache else None
+    start = 0
+    if checkpoint and len(checkpoint["het"]) == len(samples):
+        start = checkpoint["records"]
+        het[:], called[:] = checkpoint["het"], checkpoint["called"]
+        print(f"    Resuming the XH counts of {input_vcf} after {start} X records")
+
+    def reduce_chunk(chunk):
+        codes, inverse = np.unique(np.array(chunk), return_inverse=True)
+        lut = np.array([genotype_code(i) for i in codes], dtype=np.int64).reshape(-1, 2)
+        inverse = inverse.reshape(len(chunk), len(samples))
+        het[:] += lut[inverse, 0].sum(axis=0)
+        called[:] += lut[inverse, 1].sum(axis=0)
+
+    def save(records):
+        if chunk:
+            reduce_chunk(chunk)
+            chunk.clear()
+        if cache:
+            cache.put(input_vcf, "XH.checkpoint", key, {"records": records, "het": het.tolist(), "called": called.tolist()})
+
+    chunk = []
+    n = -1
+    for n, line in enumerate(records):
+        if n < start:
+            continue
+        if cache and n > start and n % XH_CHECKPOINT == 0:
+            save(n)
+        if n % shard[1] != shard[0]:
+            continue
+        lines = line.decode().rstrip("\n").split("\t", 9)
+        if len(lines) < 10:
+            continue
+        fmt = lines[8].split(":")
+        if "GT" not in fmt:
+            continue
+        if fmt[0] == "GT":
+            gt = GT_RE.findall("\t" + lines[9])
         else:
-            cmd="cat " + bamfile + ''' | awk '{print $1,$2}' | while read id dir; do mosdepth -t 4 -Q ''' + quality + " -f " + fasta + " -b " + str(Path(__file__).absolute().parent)+"/data/SRY_"+ genome_version + ".bed -n "+ outdir+"/"+"SRY/$id $dir; done"
-            runcmd(cmd)
-            cmd="cat "+bamfile+''' | awk '{print $1}' | while read id; do cat '''+outdir+"/SRY/$id.mosdepth.summary.txt | "+'''awk 'BEGIN{OFS="\\t"}NR==2{out1=$4}NR==3{out2=$4}END{if(out2!=0){print "'$id'",out2}else if(out1!=0){print "'$id'",out1}else{print "'$id'",0}}'; done | sort -n -k 1 >''' + outdir+"/SRY.txt"
+            idx = fmt.index("GT")
+            gt = [(i.split(":") + ["."] * idx)[idx] for i in lines[9].split("\t")]
+        if len(gt) != len(samples):
+            sys.exit(f'Error, the vcf record at {lines[0]}:{lines[1]} does not have one genotype per sample!')
+        chunk.append(gt)
+        if len(chunk) == sites:
+            reduce_chunk(chunk)
+            chunk.clear()
+    save(max(n + 1, start))
+    return samples, het, called
+
+def XH_counts(input_vcf, cache=None, sampleids=None):
+    '''[het, called] counts of the given samples (every sample of the VCF by default) as ({sampleid: counts}, reused).
+
+    The counts are taken from the feature cache when all of them are there
+    (reused is then True); otherwise the whole VCF is counted once and the
+    counts of every sample are cached, with the sample list under "*".
+    '''
+    wanted = sampleids if sampleids is not None else (cache.get(input_vcf, "XH", "*") if cache else None)
+    counts = {i: cache.get(input_vcf, "XH", i) for i in wanted} if cache and wanted is not None else {}
+    if counts and None not in counts.values():
+        return counts, True
+    samples, het, called = count_XH(input_vcf, cache=cache)
+    counts = {i: [int(h), int(c)] for i, h, c in zip(samples, het, called)}
+    if cache:
+        cache.put_many(input_vcf, "XH", [("*", samples)] + list(counts.items()))
+    return (counts if sampleids is None else {i: counts[i] for i in sampleids if i in counts}), False
+
+def collect_XH(input_vcf,cache=None):
+    '''X chromosome heterozygosity of every sample of the VCF as {sampleid: XH}'''
+    print(">> Collected feature of X chromosome heterozygosity")
+    counts, reused = XH_counts(input_vcf, cache)
+    if reused:
+        print(f"    {len(counts)} samples reused from the feature cache")
+    print(f'    Finish generate features of X chromosome heterozygosity at {time.ctime()} \n')
+    return {sampleid: h/c if c else 0.0 for sampleid, (h, c) in counts.items()}
+
+def sample_counts(sampleid, alignment, fill_type, fasta, quality, fast_index=False, cache=None):
+    '''Per-contig read counts of one sample as [contigs, from_index], reusing the feature cache'''
+    params = f"quality={quality};fast_index={fast_index}"
+    counts = cache.get(alignment, "contigs", sampleid, params) if cache else None
+    if counts is None:
+        contig = index_counts(alignment, fill_type) if fast_index else None
+        counts = [contig, True] if contig is not None else [count_reads(alignment, fill_type, fasta, quality), False]
+        if cache:
+            cache.put(alignment, "contigs", sampleid, counts, params)
+    return counts
+
+def check_fast_index(samples, fill_type, fasta, quality, num_threshold, outfile):
+    '''Count samples both from the index statistics and by scanning reads, and write how far Xmap/Ymap differ.
+
+    Returns the largest absolute Xmap and Ymap differences. Samples without
+    index statistics (e.g. CRAM or no .bai/.csi) are listed with NA.
+    '''
+    def both(sampleid, alignment):
+        return index_counts(alignment, fill_type), count_reads(alignment, fill_type, fasta, quality)
+
+    samples = list(samples)
+    with Pipeline(num_threshold) as pipeline:
+        keys = [pipeline.add(("fast_index_check", sampleid), staged("fast_index_check", sampleid, both, sampleid, alignment)) for sampleid, alignment in samples]
+        results = pipeline.wait(keys)
+    rows = []
+    for sampleid, _ in samples:
+        indexed, scanned = results[("fast_index_check", sampleid)]
+        scan = map_values(*sex_counts(scanned))
+        index = map_values(*sex_counts(indexed)) if indexed is not None else None
+        rows.append([sampleid] + [j for i in ["Xmap", "Ymap"] for j in ([index[i], scan[i], index[i]-scan[i]] if index else ["NA", scan[i], "NA"])])
+    with open(outfile, "w") as f:
+        f.write("sampleid\tXmap_index\tXmap_scan\tXmap_diff\tYmap_index\tYmap_scan\tYmap_diff\n")
+        for row in rows:
+            f.write("\t".join(str(i) for i in row) + "\n")
+    compared = [i for i in rows if i[3] != "NA"]
+    return max([abs(i[3]) for i in compared], default=0), max([abs(i[6]) for i in compared], default=0), len(compared)
+
+def map_values(total, x, y):
+    '''Xmap, Ymap and XYratio from the (total, X, Y) read counts of a sample'''
+    return {"Xmap": x/total if total else 0, "Ymap": y/total if total else 0, "XYratio": x/y if y else 0}
+
+def load_bed(bedfile):
+    with open(bedfile) as f:
+        return [(lines[0], int(lines[1]), int(lines[2])) for lines in (line.rstrip("\n").split("\t") for line in f)]
+
+def region_depth(alignment, fill_type, fasta, quality, regions):
+    '''Mean read depth over bed regions, fetching only the overlapping reads through the index.
+
+    Reads are filtered like mosdepth defaults (-Q quality, -F 1796) and only
+    M/=/X cigar operations are counted; mates are not overlap-corrected.
+    '''
+    contigs = read_contigs(alignment)
+    option = decode_option(fill_type, fasta, DEPTH_FIELDS)
+    regions = [i for i in regions if i[0] in contigs]
+    length = sum(end - start for _, start, end in regions)
+    if not length:
+        return 0.0
+    query = " ".join(shlex.quote(f"{chrom}:{start+1}-{end}") for chrom, start, end in regions)
+    bases = 0
+    for line in streamcmd(f"samtools view -q {int(quality)} -F 1796 {option} {shlex.quote(alignment)} {query} | cut -f 3,4,6"):
+        chrom, pos, cigar = line.decode().rstrip("\n").split("\t")
+        ref = int(pos) - 1
+        for num, op in CIGAR_RE.findall(cigar):
+            num = int(num)
+            if op in "M=X":
+                for c, start, end in regions:
+                    if c == chrom:
+                        bases += max(0, min(end, ref + num) - max(start, ref))
+            if op in "MDN=X":
+                ref += num
+    return round(bases / length, 2)
+
+def sample_SRY(sampleid, alignment, fill_type, fasta, quality, genome_version, cache=None):
+    '''Mean depth of the SRY gene of one sample, reusing the feature cache'''
+    params = f"quality={quality};genome={genome_version}"
+    depth = cache.get(alignment, "SRY", sampleid, params) if cache else None
+    if depth is None:
+        regions = load_bed(str(Path(__file__).absolute().parent)+"/data/SRY_"+ genome_version + ".bed")
+        depth = region_depth(alignment, fill_type, fasta, quality, regions)
+        if cache:
+            cache.put(alignment, "SRY", sampleid, depth, params)
+    return depth
+
+def staged(stage, sampleid, func, *args, journal=None):
+    '''Wrap func(*args) as a pipeline task whose resource usage is recorded under stage/sampleid.
+
+    With a journal, the completion of the stage is recorded and a sample
+    whose bam/cram cannot be processed is recorded as failed and gives None
+    instead of aborting the whole run.
+    '''
+    def task():
+        with METRICS.stage(stage, sampleid):
+            if journal is None:
+                return func(*args)
+            try:
+                result = func(*args)
+            except (CommandError, OSError, ValueError, sqlite3.OperationalError) as e:
+                print(f"Warning, the {stage} stage of {sampleid} failed and the sample is skipped: {str(e).splitlines()[0]}")
+                journal.fail(stage, sampleid, str(e))
+                return None
+            journal.done(stage, sampleid)
+            return result
+    return task
+
+def run_samples(samples, stages, num_threshold, shared=None, journal=None):
+    '''Run stages ({stage: func(sampleid, alignment)}) on samples, with at most MANIFEST_BATCH samples in flight.
+
+    Yields (sampleid, {stage: result}) in completion order as soon as all
+    stages of a sample are done and takes the next sample of the manifest in
+    its place, so one slow bam/cram never leaves the other workers idle;
+    failed stages are left out. The shared tasks ({key: func()}, e.g. XH over
+    the whole VCF) start before the first sample and keep their worker while
+    the samples go through the rest of the pool; their results replace the
+    functions in shared once every sample is done.
+    '''
+    shared = {} if shared is None else shared
+    samples = iter(samples)
+    results, remaining, pending, finished = {}, {}, set(), 0
+    with Pipeline(num_threshold) as pipeline:
+        for key, func in shared.items():
+            pipeline.add(key, func)
+        while True:
+            for sampleid, alignment in islice(samples, MANIFEST_BATCH - len(results)):
+                if sampleid in results:
+                    continue
+                results[sampleid], remaining[sampleid] = {}, len(stages)
+                pending.update(pipeline.add((stage, sampleid), staged(stage, sampleid, func, sampleid, alignment, journal=journal))
+                               for stage, func in stages.items())
+            if not results:
+                break
+            done = pipeline.done(pending) if pending else {}
+            for (stage, sampleid), result in done.items():
+                pending.discard((stage, sampleid))
+                remaining[sampleid] -= 1
+                if result is not None:
+                    results[sampleid][stage] = result
+            for sampleid in [i for i in dict.fromkeys(i for _, i in done) if not remaining[i]] if stages else list(results):
+                del remaining[sampleid]
+                finished += 1
+                if finished % MANIFEST_BATCH == 0:
+                    print(f">> Collected features of {finished} samples at {time.ctime()}")
+                yield sampleid, results.pop(sampleid)
+        if finished % MANIFEST_BATCH:
+            print(f">> Collected features of {finished} samples at {time.ctime()}")
+        shared.update(pipeline.wait(list(shared)))
+
+def collect_features(features, input_vcf,samples,fill_type,fasta,quality,num_threshold,genome_version,fast_index=False,cache=None,journal=None):
+    '''Return a FeatureTable of the features (XH, Xmap, Ymap, XYratio, SRY) of samples, an iterable of (sampleid, alignment).
+
+    XH over the whole VCF and every sample x stage (read counts, SRY depth)
+    are tasks of one flat pool of --num_threshold workers, so they proceed
+    concurrently; the read counts shared by Xmap, Ymap and XYratio are one
+    stage, computed once per sample. samples is consumed lazily with at most
+    MANIFEST_BATCH samples in flight (e.g. straight from read_manifest), so
+    only the feature values of the cohort are kept in memory. The features are joined by sample id, so only
+    samples present in the VCF and the manifest are kept.
+    '''
+    check_fasta(fill_type, fasta)
+    stages = {}
+    if set(features) & {"Xmap", "Ymap", "XYratio"}:
+        stages["contigs"] = partial(sample_counts, fill_type=fill_type, fasta=fasta, quality=quality, fast_index=fast_index, cache=cache)
+    if "SRY" in features:
+        stages["SRY"] = partial(sample_SRY, fill_type=fill_type, fasta=fasta, quality=quality, genome_version=genome_version, cache=cache)
+    shared = {"XH": staged("XH", "*", collect_XH, input_vcf, cache, journal=journal)} if "XH" in features else {}
+    values = {i: {} for i in features}
+    ids, from_index = set(), 0
+    for sampleid, results in run_samples(samples, stages, num_threshold, shared, journal):
+        ids.add(sampleid)
+        if "contigs" in results:
+            contig, indexed = results["contigs"]
+            from_index += indexed
+            for name, value in map_values(*sex_counts(contig)).items():
+                if name in values:
+                    values[name][sampleid] = value
+        if "SRY" in results:
+            values["SRY"][sampleid] = results["SRY"]
+    if "XH" in shared:
+        if shared["XH"] is None:
+            sys.exit(f"Error, the X chromosome heterozygosity of {input_vcf} could not be counted!")
+        values["XH"] = shared["XH"]
+    if fast_index:
+        print(f"    {from_index} of {len(ids)} samples counted from index statistics (all mapped reads, no MAPQ or pairing filter)")
+    table = reduce(lambda x, y: x.join(y), [FeatureTable.from_values(i, values[i]) for i in features])
+    failed = {i for name in features if name != "XH" for i in ids if i not in values[name]}
+    dropped = sorted(ids - set(table.ids) - failed)
+    if failed:
+        print(f"Warning, {len(failed)} samples failed and are left out of the classification")
+    if dropped:
+        print(f"Warning, {len(dropped)} samples of the manifest have no genotypes in the VCF and are skipped: {', '.join(dropped[:10])}{' ...' if len(dropped) > 10 else ''}")
+    return table
+
+def open_journal(outdir):
+    '''Open the run journal of outdir, reporting what an earlier run of the same output already did'''
+    journal = RunJournal(outdir+"/run_journal.sqlite")
+    status = journal.summary()
+    if status:
+        print(f"The run journal of {outdir} has {status.get('done', 0)} sample stages finished and {status.get('failed', 0)} failed by earlier runs; "
+              "finished ones are skipped when their values are in the feature cache (--cache), failed ones are retried")
+    return journal
+
+def report_failures(journal, outdir):
+    failed = journal.report(outdir+"/failed_samples.txt")
+    if failed:
+        print(f"Warning, {failed} samples failed, see {outdir}/failed_samples.txt")
+
+def normalize_SRY(table):
+    '''Divide the SRY depth by XYratio as in the reference files, where XYratio is not zero'''
+    if "SRY" in table and "XYratio" in table:
+        ratio = np.asarray(table["XYratio"], dtype=float)
+        table["SRY"] = np.divide(table["SRY"], ratio, out=np.asarray(table["SRY"], dtype=float).copy(), where=ratio != 0)
+    return table
+
+def parse_shard(shard):
+    '''Parse "i/N" (0-based i) into (i, N)'''
+    try:
+        i, n = (int(j) for j in shard.split("/"))
+    except ValueError:
+        sys.exit(f"Error, --shard must look like i/N (e.g. 0/8), got {shard}")
+    if not 0 <= i < n:
+        sys.exit(f"Error, the shard index must be between 0 and {n-1}, got {shard}")
+    return i, n
+
+def shard_params(input_vcf, bamfile, fill_type, quality, genome_version, fast_index):
+    '''Inputs and parameters that every shard of one run must have been collected with'''
+    return {"vcf": os.path.realpath(input_vcf), "vcf_size": os.path.getsize(input_vcf), "input": os.path.realpath(bamfile),
+            "alignment_format": fill_type, "quality": str(quality), "genome": genome_version, "fast_index": bool(fast_index)}
+
+def collect_shard(columns, input_vcf,bamfile,fill_type,fasta,quality,num_threshold,genome_version,outdir,shard,fast_index=False,cache=None,journal=None):
+    '''Collect the raw counts of one shard and write outdir/shard_<i>_of_<N>.txt for `seGMM merge`.
+
+    The shard covers every N-th sample of the manifest and every N-th X record
+    of the VCF. XH is written as het/called counts so the merge can sum them,
+    and the header records the inputs and parameters (shard_params) that all
+    shards of one run must share.
+    '''
+    check_fasta(fill_type, fasta)
+    i, n = shard
+    samples = (s for k, s in enumerate(read_manifest(bamfile)) if k % n == i)
+    stages = {}
+    if set(columns) & {"Xmap", "Ymap", "XYratio"}:
+        stages["contigs"] = partial(sample_counts, fill_type=fill_type, fasta=fasta, quality=quality, fast_index=fast_index, cache=cache)
+    if "SRY" in columns:
+        stages["SRY"] = partial(sample_SRY, fill_type=fill_type, fasta=fasta, quality=quality, genome_version=genome_version, cache=cache)
+    shared = {"XH": staged("XH", "*", count_XH, input_vcf, XH_CHUNK_SIZE, shard, cache, journal=journal)} if "XH" in columns else {}
+
+    rows = {}
+    for sampleid, results in run_samples(samples, stages, num_threshold, shared, journal):
+        row = rows.setdefault(sampleid, ["NA"] * 6)
+        if "contigs" in results:
+            row[0:3] = sex_counts(results["contigs"][0])
+        if "SRY" in results:
+            row[3] = results["SRY"]
+    count = len(rows)
+    if "XH" in shared and shared["XH"] is None:
+        sys.exit(f"Error, the X chromosome heterozygosity of {input_vcf} could not be counted!")
+    if "XH" in shared:
+        for sampleid, het, called in zip(*shared["XH"]):
+            rows.setdefault(sampleid, ["NA"] * 6)[4:6] = [int(het), int(called)]
+    outfile = f"{outdir}/shard_{i}_of_{n}.txt"
+    with open(outfile, "w") as f:
+        params = shard_params(input_vcf, bamfile, fill_type, quality, genome_version, fast_index)
+        f.write(f"#shard\t{i}/{n}\t{','.join(columns)}\t{json.dumps(params, sort_keys=True)}\n")
+        f.write("sampleid\ttotal\tX\tY\tSRY\tXH_het\tXH_called\n")
+        for sampleid, row in sorted(rows.items()):
+            f.write("\t".join([sampleid] + [str(j) for j in row]) + "\n")
+    print(f">> Wrote the counts of shard {i}/{n} ({count} samples) to {outfile}")
+
+def merge_shards(shard_files):
+    '''Combine shard files into one FeatureTable.
+
+    XH numerators and denominators are summed over shards before dividing, and
+    every shard 0..N-1 of the same run must be present exactly once, collected
+    from the same VCF and manifest with the same parameters.
+    '''
+    columns, params, seen, counts = None, None, {}, {}
+    for shard_file in shard_files:
+        with open(shard_file) as f:
+            header = f.readline().rstrip("\n").split("\t")
+            if header[0] != "#shard" or len(header) not in [3, 4]:
+                sys.exit(f"Error, {shard_file} is not a seGMM shard file!")
+            tag, shard, names = header[:3]
+            header_params = json.loads(header[3]) if len(header) == 4 else {}
+            if params is not None and header_params != params:
+                keys = sorted(k for k in set(params) | set(header_params) if params.get(k) != header_params.get(k))
+                sys.exit(f"Error, {shard_file} was collected with different {', '.join(keys)} than the other shards!")
+            params = header_params
+            if columns is not None and names.split(",") != columns:
+                sys.exit(f"Error, {shard_file} was collected with different features ({names})!")
+            columns = names.split(",")
+            i, n = parse_shard(shard)
+            if i in seen or (seen and n != next(iter(seen.values()))):
+                sys.exit(f"Error, {shard_file} repeats shard {shard} or belongs to a different run!")
+            seen[i] = n
+            f.readline()
+            for line in f:
+                lines = line.rstrip("\n").split("\t")
+                row = counts.setdefault(lines[0], {"het": 0, "called": 0})
+                for key, value in zip(["total", "X", "Y", "SRY"], lines[1:5]):
+                    if value != "NA":
+                        row[key] = float(value)
+                if lines[5] != "NA":
+                    row["vcf"] = True
+                    row["het"] += int(lines[5])
+                    row["called"] += int(lines[6])
+    n = next(iter(seen.values()))
+    if sorted(seen) != list(range(n)):
+        sys.exit(f"Error, shards {', '.join(str(i) for i in range(n) if i not in seen)} of {n} are missing!")
+
+    required = {"XH": "vcf", "Xmap": "total", "Ymap": "total", "XYratio": "total", "SRY": "SRY"}
+    table = {}
+    for sampleid, row in sorted(counts.items()):
+        missing = sorted({required[i] for i in columns if required[i] not in row})
+        if missing:
+            print(f"Warning, {sampleid} has no {' or '.join('bam/cram counts' if i == 'total' else i for i in missing)} in the shards and is skipped")
+            continue
+        values = {
+            "XH": row["het"]/row["called"] if row["called"] else 0.0,
+            "Xmap": row["X"]/row["total"] if row.get("total") else 0,
+            "Ymap": row["Y"]/row["total"] if row.get("total") else 0,
+            "XYratio": row["X"]/row["Y"] if row.get("Y") else 0,
+            "SRY": row.get("SRY", 0),
+        }
+        table[sampleid] = [values[i] for i in columns]
+    return FeatureTable(list(table), {name: [row[k] for row in table.values()] for k, name in enumerate(columns)})
+
+def sample_features(sampleid, alignment, input_vcf, features, fill_type, fasta, quality, genome_version, fast_index=False, cache=None):
+    '''Compute the requested features of a single sample in-process, without writing any file.
+
+    The SRY depth is divided by XYratio when both are requested, as in the
+    --reference_additional mode.
+    '''
+    check_fasta(fill_type, fasta)
+    values = {}
+    if set(features) & {"Xmap", "Ymap", "XYratio"}:
+        values.update(map_values(*sex_counts(sample_counts(sampleid, alignment, fill_type, fasta, quality, fast_index, cache)[0])))
+    if "SRY" in features:
+        depth = sample_SRY(sampleid, alignment, fill_type, fasta, quality, genome_version, cache)
+        values["SRY"] = depth/values["XYratio"] if "XYratio" in features and values["XYratio"] else depth
+    if "XH" in features:
+        counts, _ = XH_counts(input_vcf, cache, [sampleid])
+        if sampleid not in counts:
+            raise ValueError(f"Sample {sampleid} is not in {input_vcf}")
+        het, called = counts[sampleid]
+        values["XH"] = het/called if called else 0.0
+    return {i: values[i] for i in features}
+
+def read_reference_header(ref):
+    '''Validate the header of a reference feature file and return ["sampleid", features...]'''
+    order = ["XH","Xmap","Ymap","XYratio","SRY"]
+    features = ["sampleid"]
+    with open(ref) as f:
+        header=f.readline().rstrip("\n").split("\t")
+    if header[0]!="sampleid":
+        sys.exit("Error, the first column for reference file must is sampleid!")
+    for i in range(1,len(header)):
+        if header[i] not in order:
+            sys.exit("Error. The header of reference data is wrong. "
+                "Please make sure the header of reference data is: sampleid, XH, Xmap, Yamp, XYratio, SRY")
+        else:
+            features.append(header[i])
+    return features
+
+def run_GMM(table, uncertain_threshold, outdir, backend="R"):
+    '''Write outdir/feature.txt and classify it into outdir/seGMM_result.txt'''
+    table.write(outdir+"/feature.txt")
+    if not len(table):
+        sys.exit("Error, no sample has all the features, please check that the sample ids of the VCF and the bam/cram list match!")
+    with METRICS.stage(f"GMM.{backend}"):
+        if backend == "python":
+            result, fit = gmm.classify_table(table, float(uncertain_threshold))
+            outliers = result["uncertainty"] >= float(uncertain_threshold)
+            print(f"There are {int(outliers.sum())} outliers samples based on prediction uncertainty")
+            print([i for i, o in zip(result.ids, outliers) if o])
+            print(f"GMM model: {fit['model']} (BIC {fit['bic']:.2f})")
+            gmm.write_result(outdir+"/seGMM_result.txt", result.ids, table.names, table.matrix(), result["Predict"], result["karyotypes"])
+        else:
+            cmd=f"Rscript {shlex.quote(str(Path(__file__).absolute().parent))}/script/seGMM.r {shlex.quote(outdir+'/feature.txt')} {float(uncertain_threshold)} {shlex.quote(outdir)}"
             runcmd(cmd)
-    print('    Finish generate features of mean depth of SRY gene at {T} \n'.format(T=time.ctime()))
-
-
-def with_reference(feature, input_vcf,bamfile,fill_type,fasta,quality,num_threshold,genome_version,outdir):
-    collect_map(bamfile,fill_type,fasta,quality,num_threshold,outdir)
-    if feature == "XH":
-        collect_XH(input_vcf,outdir)
-    if feature == "Xmap":
-        collect_map(bamfile,fill_type,fasta,quality,num_threshold,outdir,["X", "chrX"])
-    if feature == "Ymap":
-        collect_map(bamfile,fill_type,fasta,quality,num_threshold,outdir,["Y", "chrY"])
-    if feature == "SRY":
-        collect_SRY(bamfile,fill_type,fasta,quality,genome_version,outdir)
-    if feature == "XYratio":
-        Xmap = outdir+"/Xmap.txt"
-        Ymap = outdir+"/Ymap.txt"
-        if not os.path.isfile(Xmap):
-            collect_map(bamfile,fill_type,fasta,quality,num_threshold,outdir,["X", "chrX"])
-        if not os.path.isfile(Ymap):
-            collect_map(bamfile,fill_type,fasta,quality,num_threshold,outdir,["Y", "chrY"])
-        XYratio = outdir+"/XYratio.txt"
-        cmd = "join "+Xmap+" " + Ymap + ''' | awk 'BEGIN{OFS="\\t"}{print $1,$2/$3}' >''' + XYratio
-        runcmd(cmd)
+
+def extraction_options():
+    '''argparse parent with the feature-extraction options shared by seGMM score and seGMM serve'''
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--model","-m",required = True,help = "Reference model written by seGMM fit-reference.")
+    parser.add_argument("--reference_fasta","-R",required = False,help = "Reference genome for CRAM support (if CRAM is used). [default: '']")
+    parser.add_argument("--genome","-g",required = False,help = "Genome version. [default: hg19]. ",choices=["hg19","hg38"],default="hg19")
+    parser.add_argument("--quality","-q",required = False,help = "Mapping quality threshold of reads to count. [default: 30].",default="30")
+    parser.add_argument("--cache",required = False,help = "Feature cache database reused across runs (seGMM score defaults to <output>/feature_cache.sqlite, seGMM serve uses none unless given).")
+    parser.add_argument("--fast_index","--fast-index",required = False,action = "store_true",help = "Derive total/X/Y mapping counts from the bam index statistics instead of scanning reads.")
+    return parser
+
+def classification_options():
+    '''argparse parent with the GMM options shared by seGMM score, merge and serve'''
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--uncertain_threshold","-u",required = False,help = "The threshold for detecting outliers in GMM model. [default: 0.1]. The range of threshold is 0-1!",default="0.1")
+    return parser
+
+def fit_reference_main(argv):
+    parser = argparse.ArgumentParser(prog="seGMM fit-reference", description = "Fit the GMM once on a reference feature file and save it for `seGMM score`.")
+    parser.add_argument("--reference_additional","-r",required = True,help = "Reference file which contain features (sampleid, XH, Xmap, Ymap, XYratio, SRY).")
+    parser.add_argument("--output","-o",required = True,help = "Path of the reference model to write (JSON).")
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.reference_additional):
+        sys.exit("The reference data is not exist!")
+    if len(read_reference_header(args.reference_additional)) <= 2:
+        sys.exit("Error. At least two of features required to be included within reference file!")
+    ids, names, X = gmm.read_features(args.reference_additional)
+    model = gmm.fit_reference(names, X)
+    gmm.save_model(model, args.output)
+    print(f"Reference model {model['model']} fitted on {len(ids)} samples with features {', '.join(names)}, saved to {args.output}")
+
+def score_main(argv):
+    parser = argparse.ArgumentParser(prog="seGMM score", description = "Classify samples against a reference model from `seGMM fit-reference` without refitting the GMM.",
+                                     parents=[extraction_options(), classification_options()])
+    parser.add_argument("--vcf","-vcf",required = True,help = "Input VCF file.")
+    parser.add_argument("--input","-i",required = True,help = "Input file contain sampleid and directory of bam/cram files (no header)")
+    parser.add_argument("--alignment_format","-a",required = True,help = "Alignment format type for the input data",choices=["BAM","CRAM"])
+    parser.add_argument("--output","-o",required = True,help = "Prefix of output directory.")
+    parser.add_argument("--num_threshold","-n",required = False,help = "Number of additional threads to use. [default: 1].",default="1")
+    args = parser.parse_args(argv)
+    fasta = str(os.path.realpath(args.reference_fasta)) if args.reference_fasta else " "
+    for path in [args.model, args.vcf, args.input]:
+        if not os.path.isfile(path):
+            sys.exit(f"Error, {path} is not exist, please check that you have provided the correct path!")
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    model = gmm.load_model(args.model)
+    start_time = time.time()
+    cache = FeatureCache(args.cache or args.output+"/feature_cache.sqlite")
+    journal = open_journal(args.output)
+    table = normalize_SRY(collect_features(model["features"], args.vcf,read_manifest(args.input),args.alignment_format,fasta,args.quality,args.num_threshold,args.genome,args.fast_index,cache,journal))
+    report_failures(journal, args.output)
+    table.write(args.output+"/feature.txt")
+    print(">> Scoring samples against the reference model")
+    with METRICS.stage("score"):
+        result, _ = gmm.classify_table(table, float(args.uncertain_threshold), model)
+    gmm.write_result(args.output+"/seGMM_result.txt", result.ids, table.names, table.matrix(), result["Predict"], result["karyotypes"])
+    print(f"There are {int(np.sum(result['uncertainty'] >= float(args.uncertain_threshold)))} outliers samples based on prediction uncertainty")
+    METRICS.write(args.output)
+    print(f'Total time elapsed: {sec_to_str(round(time.time()-start_time,2))} \n')
+
+def merge_main(argv):
+    parser = argparse.ArgumentParser(prog="seGMM merge", description = "Combine the shard files of `seGMM --shard i/N` runs and classify the whole cohort once.",
+                                     parents=[classification_options()])
+    parser.add_argument("shards",nargs="+",help = "Shard files (shard_<i>_of_<N>.txt) of every shard of the run.")
+    parser.add_argument("--output","-o",required = True,help = "Prefix of output directory.")
+    parser.add_argument("--backend","-b",required = False,help = "Implementation of the GMM classifier. [default: R]",choices=["R","python"],default="R")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    start_time = time.time()
+    table = merge_shards(args.shards)
+    print(f">> Merged {len(args.shards)} shards into {len(table)} samples")
+    print(">> Running sample classification based on GMM model")
+    run_GMM(table, args.uncertain_threshold, args.output, args.backend)
+    METRICS.write(args.output)
+    print(f'Total time elapsed: {sec_to_str(round(time.time()-start_time,2))} \n')
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "fit-reference":
+        return fit_reference_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "score":
+        return score_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        return merge_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        if __package__:
+            from .server import serve_main
+        else:
+            from server import serve_main
+        return serve_main(sys.argv[2:])
+
     description = "seGMM is a tool for gender determination from massively parallel sequencing data based on Gaussian mixture model."
     __version__ = '1.3.0'
     header = "\n"
@@ -189,6 +798,11 @@ def main():
     parser.add_argument("--uncertain_threshold","-u",required = False,help = "The threshold for detecting outliers in GMM model. [default: 0.1]. The range of threshold is 0-1!",default=0.1)
     parser.add_argument("--num_threshold","-n",required = False,help = "Number of additional threads to use. [default: 1].")
     parser.add_argument("--quality","-q",required = False,help = "Mapping quality threshold of reads to count. [default: 30].")
+    parser.add_argument("--backend","-b",required = False,help = "Implementation of the GMM classifier. 'R' runs script/seGMM.r with mclust, 'python' runs the built-in NumPy port of the same models and karyotype rules. [default: R]",choices=["R","python"],default="R")
+    parser.add_argument("--cache",required = False,help = "Feature cache database reused across runs. Only samples whose bam/cram/vcf file or parameters changed are recomputed. Do not share one cache between concurrent --shard jobs on a network filesystem. [default: <output>/feature_cache.sqlite, <output>/shard_<i>_of_<N>/feature_cache.sqlite with --shard]")
+    parser.add_argument("--fast_index","--fast-index",required = False,action = "store_true",help = "Derive total/X/Y mapping counts from the bam index statistics instead of scanning reads. Samples without index statistics are scanned as usual.")
+    parser.add_argument("--fast_index_check",required = False,help = "Count the first N samples of --input both from the bam index statistics and by scanning reads, and write their Xmap/Ymap differences to <output>/fast_index_check.txt, to measure the error of --fast_index. [default: 0]",default="0")
+    parser.add_argument("--shard",required = False,help = "Only collect the counts of shard i/N (0-based i): every N-th sample of --input and every N-th X record of --vcf. The shard file is written to <output>/shard_<i>_of_<N>.txt and the cache, run journal, failed samples and metrics of the shard to <output>/shard_<i>_of_<N>/, so all shards can share one --output. The shard files are combined and classified with `seGMM merge`. Requires --type, not available with --reference_additional.")
     genome="hg19"
     uncertain_threshold="0.1"
     num_threshold="1"
@@ -219,9 +833,20 @@ def main():
             sys.exit('Error, the input vcf file is not exist, please check that you have provided the correct path!')
         if not os.path.isfile(args.input):
             sys.exit('Error, the input bam/cram file is not exist, please check that you have provided the correct path!')
+        shard = parse_shard(args.shard) if args.shard else None
+        if shard and args.reference_additional:
+            sys.exit('Error, --shard collects raw counts for seGMM merge and cannot be used with --reference_additional!')
         if not os.path.exists(args.output):
             os.makedirs(args.output)
             print(f"Warning, the output file is not exist, seGMM creates the output folder of {args.output} first!")
+        # concurrent shard jobs must not share SQLite databases or overwrite each other's reports
+        rundir = f"{args.output}/shard_{shard[0]}_of_{shard[1]}" if shard else args.output
+        os.makedirs(rundir, exist_ok=True)
+        cache = FeatureCache(args.cache or rundir+"/feature_cache.sqlite")
+        journal = open_journal(rundir)
+        if int(args.fast_index_check) > 0:
+            xmap, ymap, compared = check_fast_index(islice(read_manifest(args.input), int(args.fast_index_check)), args.alignment_format, fasta, quality, num_threshold, rundir+"/fast_index_check.txt")
+            print(f">> Compared index statistics with read scans for {compared} samples: largest Xmap difference {xmap:.6g}, largest Ymap difference {ymap:.6g} (see {rundir}/fast_index_check.txt)")
         if os.path.isfile(args.input) and os.path.isfile(args.vcf) and os.path.exists(args.output):
             if args.reference_additional is None:
                 if args.type not in ["WES", "WGS", "TGS"]:
@@ -236,38 +861,25 @@ def main():
                 
                 print(f'Beginning to generate features at {time.ctime()}')
                 start_time = time.time()
-                join = []
-                header, line, l = '"sampleid"', "$1", 1
-                line = "$1"
-                l = 1
-                collect_map(args.input,args.alignment_format,fasta,quality,num_threshold,args.output)
+                collected = []
                 if args.type in ["WGS", "WES"] or (args.chromosome in ["x", "xy"]):
-                    collect_XH(args.vcf,args.output)
-                    collect_map(args.input,args.alignment_format,fasta,quality,num_threshold,args.output,["X", "chrX"])
-                    join.append(f"{args.output}/XH.sorted.txt")
-                    join.append(f"{args.output}/Xmap.txt")
-                    header, line, l = f'{header},"XH","Xmap"', f'{line},${l+1},${l+2}', l+2
+                    collected += ["XH", "Xmap"]
                 if args.type in ["WGS", "WES"] or (args.chromosome in ["y", "xy"]):
-                    collect_map(args.input,args.alignment_format,fasta,quality,num_threshold,args.output,["Y", "chrY"])
-                    join.append(f"{args.output}/Ymap.txt")
-                    header, line, l = f'{header},"Ymap"', f'{line},${l+1}', l+1
+                    collected.append("Ymap")
                 if args.type in ["WGS", "WES"] or args.chromosome == "xy":
-                    header, line = f'{header},"XYratio"', f'{line},${l-1}/${l}'
+                    collected.append("XYratio")
                 if args.type in ["WGS", "WES"] or (args.SRY == "True"):
-                    collect_SRY(args.input,args.alignment_format,fasta,quality,genome,args.output)
-                    join.append(f"{args.output}/SRY.txt")
-                    header, line, l = f'{header},"SRY"', f'{line},$NF', l+1
-                cmd = 'join '
-                for i, j in enumerate(join):
-                    if i < 2:
-                        cmd+=f"{j} "
-                    else:
-                        cmd += f"| join - {j} "
-                cmd += f"""| awk 'BEGIN{{OFS="\\t";print {header}}}{{ print {line} }}' > {args.output}/feature.txt"""
-                runcmd(cmd)
+                    collected.append("SRY")
+                if shard:
+                    collect_shard(collected, args.vcf,args.input,args.alignment_format,fasta,quality,num_threshold,genome,args.output,shard,args.fast_index,cache,journal)
+                    report_failures(journal, rundir)
+                    METRICS.write(rundir)
+                    print(f'Run metrics are written to {rundir}/metrics.json and {rundir}/metrics.prom')
+                    return
+                table = collect_features(collected, args.vcf,read_manifest(args.input),args.alignment_format,fasta,quality,num_threshold,genome,args.fast_index,cache,journal)
+                report_failures(journal, args.output)
                 print(">> Running sample classification based on GMM model")
-                cmd=f"Rscript {str(Path(__file__).absolute().parent)}/script/seGMM.r {args.output}/feature.txt {str(uncertain_threshold)} {args.output}"
-                runcmd(cmd)
+                run_GMM(table, uncertain_threshold, args.output, args.backend)
             else:
                 if not os.path.isfile(args.reference_additional):
                     print("The reference data is not exist!")
@@ -275,20 +887,7 @@ def main():
                 else:
                     ref = os.path.abspath(args.reference_additional)
                     if args.chromosome is None:
-                        order = ["XH","Xmap","Ymap","XYratio","SRY"]
-                        features = ["sampleid"]
-                        with open(ref) as f:
-                            line=f.readline()
-                            header=line.rstrip("\n").split("\t")
-                        f.close()
-                        if header[0]!="sampleid":
-                            sys.exit("Error, the first column for reference file must is sampleid!")
-                        for i in range(1,len(header)):
-                            if header[i] not in order:
-                                sys.exit("Error. The header of reference data is wrong. "
-                                    "Please make sure the header of reference data is: sampleid, XH, Xmap, Yamp, XYratio, SRY")
-                            else:
-                                features.append(header[i])
+                        features = read_reference_header(ref)
                         if len(features)<=1 :
                             sys.exit(
                                 "Error. At least two of features required to be "
@@ -296,58 +895,24 @@ def main():
                         else:
                             print(f'Beginning generate features at {time.ctime()}')
                             start_time = time.time()
-                            cmd = "cp " + ref + " " + args.output+"/feature.txt"
-                            runcmd(cmd)
-                            idx = 0
-                            feature_combine = []
-                            SRY = 0
-                            XYratio = 0
-                            for i in range(1,len(features)):
-                                feature = args.output+"/"+features[i]+".txt"
-                                if features[i] == "SRY":
-                                    SRY = 1
-                                    SRY_index = i
-                                if features[i] == "XYratio":
-                                    XYratio = 1
-                                    XYratio_index = i
-                                if not os.path.isfile(feature):
-                                    with_reference(features[i], args.vcf,args.input,args.alignment_format,fasta,quality,num_threshold,genome,args.output)
-                                if idx==0:
-                                    with open(feature) as f:
-                                        line=f.readline()
-                                        while line:
-                                            lines=line.rstrip("\n").split("\t")
-                                            feature_combine.append(lines)
-                                            line = f.readline()
-                                    f.close()
-                                    idx=1
-                                else:
-                                    line_num=0
-                                    with open(feature) as f:
-                                        line=f.readline()
-                                        while line:
-                                            lines=line.rstrip("\n").split("\t")
-                                            feature_combine[line_num].append(lines[1])
-                                            line_num += 1
-                                            line=f.readline()
-                                    f.close()
-                            feature_file = args.output+"/feature.txt"
-                            with open(feature_file,'a+')as xh:
-                                for i in range(0,len(feature_combine)):
-                                    if XYratio == 1 and SRY == 1:
-                                        feature_combine[i][SRY_index] = str(float(feature_combine[i][SRY_index])/float(feature_combine[i][XYratio_index]))
-                                    xh.write('\t'.join(feature_combine[i])+'\n')
-                            xh.close()
+                            reference = FeatureTable.read(ref)
+                            table = normalize_SRY(collect_features(features[1:], args.vcf,read_manifest(args.input),args.alignment_format,fasta,quality,num_threshold,genome,args.fast_index,cache,journal))
+                            report_failures(journal, args.output)
+                            table = reference.concat(table)
                         print(">> Running sample classfication based on GMM model")
-                        cmd="Rscript "+ str(Path(__file__).absolute().parent)+"/script/seGMM.r " +args.output+"/feature.txt "+str(uncertain_threshold)+" "+args.output
-                        runcmd(cmd)
+                        run_GMM(table, uncertain_threshold, args.output, args.backend)
                     else:
                         print("Error, the --chromosome paremeter is not useful with an additional file!")
                         sys.exit()
         print(f'\nAnalysis complete for seGMM at {time.ctime()}')
         time_elapsed = round(time.time()-start_time,2)
         print(f'Total time elapsed: {sec_to_str(time_elapsed)} \n')
+        METRICS.write(args.output)
+        print(f'Run metrics are written to {args.output}/metrics.json and {args.output}/metrics.prom')
         print(end)
+    except CommandError as e:
+        print(e)
+        sys.exit("Please check parameters!")
     except Exception:
         print("Error, please read the protocol of seGMM")
         raise
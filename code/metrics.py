@@ -0,0 +1,158 @@
+############################################################################
+# File Name: metrics
+# Description: per-stage and per-command run metrics (metrics.json / metrics.prom)
+############################################################################
+
+import json, os, resource, threading, time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+def thread_bytes_read():
+    '''Bytes the calling thread has read from storage (read_bytes of /proc/thread-self/io), 0 where unavailable'''
+    try:
+        with open("/proc/thread-self/io") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("read_bytes:"))
+    except (OSError, StopIteration, ValueError):
+        return 0
+
+def escape(value):
+    '''Prometheus label value escaping'''
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    '''Thread-safe recorder of stage and external command resource usage.
+
+    Stages are timed with `with METRICS.stage(name, sample):`; commands run
+    inside a stage (on the same thread) are attributed to it, so the time
+    spent in samtools for one bam can be told apart from the rest. Totals per
+    stage and per tool are kept for the whole run, while the per-sample
+    records can be limited to the most recent ones for long-lived processes.
+    '''
+
+    def __init__(self, records=None):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = deque(maxlen=records)
+        self.commands = deque(maxlen=records)
+        self.stage_totals = defaultdict(lambda: {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "bytes_read": 0})
+        self.tool_totals = defaultdict(lambda: {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "bytes_read": 0, "peak_rss_kb": 0})
+        self.start = time.time()
+
+    def limit(self, records):
+        '''Keep only the last `records` stage and command records (totals are unaffected)'''
+        with self.lock:
+            self.stages = deque(self.stages, maxlen=records)
+            self.commands = deque(self.commands, maxlen=records)
+
+    def context(self):
+        return getattr(self.local, "context", (None, None, None))
+
+    @contextmanager
+    def stage(self, name, sample=None):
+        previous = self.context()
+        usage = {"commands": 0, "command_cpu_seconds": 0.0, "command_peak_rss_kb": 0, "command_bytes_read": 0}
+        self.local.context = (name, sample, usage)
+        wall, cpu, read = time.perf_counter(), time.thread_time(), thread_bytes_read()
+        try:
+            yield
+        finally:
+            record = {"stage": name, "sample": sample, "wall_seconds": time.perf_counter() - wall,
+                      "cpu_seconds": time.thread_time() - cpu, **usage}
+            record["bytes_read"] = thread_bytes_read() - read + usage["command_bytes_read"]
+            self.local.context = previous
+            if previous[2] is not None:
+                parent = previous[2]
+                parent["commands"] += usage["commands"]
+                parent["command_cpu_seconds"] += usage["command_cpu_seconds"]
+                parent["command_bytes_read"] += usage["command_bytes_read"]
+                parent["command_peak_rss_kb"] = max(parent["command_peak_rss_kb"], usage["command_peak_rss_kb"])
+            with self.lock:
+                self.stages.append(record)
+                totals = self.stage_totals[name]
+                totals["count"] += 1
+                for key in ["wall_seconds", "cpu_seconds", "bytes_read"]:
+                    totals[key] += record[key]
+
+    def wait(self, proc, command, start):
+        '''Reap a subprocess with wait4, record its resource usage and return its exit code'''
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        stage, sample, stage_usage = self.context()
+        record = {"command": command, "tool": command.split()[0] if command.split() else "", "stage": stage, "sample": sample,
+                  "wall_seconds": time.perf_counter() - start, "cpu_seconds": usage.ru_utime + usage.ru_stime,
+                  "peak_rss_kb": usage.ru_maxrss, "bytes_read": usage.ru_inblock * 512, "returncode": proc.returncode}
+        if stage_usage is not None:
+            stage_usage["commands"] += 1
+            stage_usage["command_cpu_seconds"] += record["cpu_seconds"]
+            stage_usage["command_bytes_read"] += record["bytes_read"]
+            stage_usage["command_peak_rss_kb"] = max(stage_usage["command_peak_rss_kb"], record["peak_rss_kb"])
+        with self.lock:
+            self.commands.append(record)
+            totals = self.tool_totals[(record["tool"], stage)]
+            totals["count"] += 1
+            for key in ["wall_seconds", "cpu_seconds", "bytes_read"]:
+                totals[key] += record[key]
+            totals["peak_rss_kb"] = max(totals["peak_rss_kb"], record["peak_rss_kb"])
+        return proc.returncode
+
+    def summary(self):
+        run = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self.lock:
+            stages = {name: dict(i) for name, i in self.stage_totals.items()}
+            tool_totals = {key: dict(i) for key, i in self.tool_totals.items()}
+        tools = defaultdict(lambda: {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "bytes_read": 0, "peak_rss_kb": 0})
+        for (name, _), i in tool_totals.items():
+            tool = tools[name]
+            for key in ["count", "wall_seconds", "cpu_seconds", "bytes_read"]:
+                tool[key] += i[key]
+            tool["peak_rss_kb"] = max(tool["peak_rss_kb"], i["peak_rss_kb"])
+        return {"wall_seconds": time.time() - self.start,
+                "cpu_seconds": run.ru_utime + run.ru_stime,
+                "children_cpu_seconds": children.ru_utime + children.ru_stime,
+                "peak_rss_kb": run.ru_maxrss,
+                "children_peak_rss_kb": children.ru_maxrss,
+                "bytes_read": (run.ru_inblock + children.ru_inblock) * 512,
+                "stages": stages, "tools": dict(tools),
+                "tool_stages": [{"tool": name, "stage": stage, **i} for (name, stage), i in tool_totals.items()]}
+
+    def write(self, outdir):
+        '''Write metrics.json (with the per-sample records) and a Prometheus textfile (metrics.prom, per stage and tool) to outdir'''
+        with self.lock:
+            stages, commands = list(self.stages), list(self.commands)
+        with open(outdir+"/metrics.json", "w") as f:
+            json.dump({"run": self.summary(), "stages": stages, "commands": commands}, f, indent=1)
+        with open(outdir+"/metrics.prom", "w") as f:
+            f.write(self.prometheus())
+
+    def prometheus(self):
+        '''Prometheus text exposition of the run totals and the per stage and per tool aggregates'''
+        summary = self.summary()
+
+        def labels(**kwargs):
+            return ",".join(f'{k}="{escape(v)}"' for k, v in kwargs.items() if v is not None)
+
+        lines = []
+        for name, help_text, value in [
+            ("segmm_run_wall_seconds", "Wall time of the seGMM run", summary["wall_seconds"]),
+            ("segmm_run_cpu_seconds", "CPU time of the seGMM process", summary["cpu_seconds"]),
+            ("segmm_run_children_cpu_seconds", "CPU time of external commands", summary["children_cpu_seconds"]),
+            ("segmm_run_peak_rss_kb", "Peak resident set size of the seGMM process", summary["peak_rss_kb"]),
+            ("segmm_run_bytes_read", "Bytes read from disk by seGMM and its commands", summary["bytes_read"])]:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        for metric, key, help_text in [("segmm_stage_count", "count", "Number of stage runs (one per sample for per-sample stages)"),
+                                       ("segmm_stage_wall_seconds", "wall_seconds", "Wall time summed over the runs of a stage"),
+                                       ("segmm_stage_cpu_seconds", "cpu_seconds", "CPU time of the seGMM thread summed over the runs of a stage"),
+                                       ("segmm_stage_bytes_read", "bytes_read", "Bytes read from disk by a stage and its commands")]:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            lines += [f"{metric}{{{labels(stage=name)}}} {i[key]}" for name, i in summary["stages"].items()]
+        for metric, key, help_text in [("segmm_command_count", "count", "Number of external commands per tool and stage"),
+                                       ("segmm_command_wall_seconds", "wall_seconds", "Wall time of external commands per tool and stage"),
+                                       ("segmm_command_cpu_seconds", "cpu_seconds", "CPU time of external commands per tool and stage"),
+                                       ("segmm_command_bytes_read", "bytes_read", "Bytes read from disk by external commands per tool and stage"),
+                                       ("segmm_command_peak_rss_kb", "peak_rss_kb", "Largest peak resident set size of an external command per tool and stage")]:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            lines += [f"{metric}{{{labels(tool=i['tool'], stage=i['stage'])}}} {i[key]}" for i in summary["tool_stages"]]
+        return "\n".join(lines)+"\n"
+
+METRICS = Metrics()
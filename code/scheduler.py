@@ -0,0 +1,41 @@
+############################################################################
+# File Name: scheduler
+# Description: keyed feature-extraction tasks on one shared worker pool
+############################################################################
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+class Pipeline:
+    '''Tasks keyed by name, run on one pool of workers shared by all samples of a run.
+
+    Adding a key that is still pending keeps the first task, so a stage shared
+    by several features (e.g. the read counts behind Xmap, Ymap and XYratio)
+    runs once. wait() and done() only collect the given keys, so a long task
+    such as XH over the whole VCF keeps its worker while samples go through
+    the rest of the pool.
+    '''
+
+    def __init__(self, workers=1):
+        self.pool = ThreadPoolExecutor(max_workers=max(1, int(workers)))
+        self.futures = {}
+
+    def add(self, key, func):
+        if key not in self.futures:
+            self.futures[key] = self.pool.submit(func)
+        return key
+
+    def wait(self, keys):
+        '''Return {key: result} of the given tasks, forgetting them once done'''
+        return {key: self.futures.pop(key).result() for key in list(dict.fromkeys(keys))}
+
+    def done(self, keys):
+        '''Block until at least one of the given tasks finishes and return {key: result} of the finished ones, forgetting them'''
+        finished, _ = wait([self.futures[key] for key in keys], return_when=FIRST_COMPLETED)
+        keys = [key for key in keys if self.futures[key] in finished]
+        return {key: self.futures.pop(key).result() for key in keys}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,138 @@
+############################################################################
+# File Name: server
+# Description: resident scoring service for single-sample submissions
+############################################################################
+
+import argparse, json, os, socketserver, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+if __package__:
+    from . import gmm
+    from .cache import FeatureCache
+    from .main import classification_options, extraction_options, sample_features
+    from .metrics import METRICS
+else:
+    import gmm
+    from cache import FeatureCache
+    from main import classification_options, extraction_options, sample_features
+    from metrics import METRICS
+
+# stage/command records kept by a long-running server; the per-stage and per-tool totals cover all requests
+METRICS_RECORDS = 10000
+
+class Scorer:
+    '''Frozen reference model plus a bounded pool of feature-extraction workers.
+
+    At most `workers` samples are processed at once and at most `queue` more
+    wait for a worker; further submissions are rejected instead of piling up.
+    '''
+
+    def __init__(self, model, workers, queue, fill_type, fasta, quality, genome, uncertain_threshold, fast_index=False, cache=None):
+        self.model = model
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.options = dict(fill_type=fill_type, fasta=fasta, quality=quality, genome_version=genome, fast_index=fast_index, cache=cache)
+        self.uncertain_threshold = uncertain_threshold
+
+    def score(self, sampleid, alignment, input_vcf, fill_type=None):
+        start = time.time()
+        options = dict(self.options)
+        if fill_type:
+            options["fill_type"] = fill_type
+        with METRICS.stage("score", sampleid):
+            features = sample_features(sampleid, alignment, input_vcf, self.model["features"], **options)
+            X = np.array([[features[i] for i in self.model["features"]]])
+            predict, karyotype, uncertainty = gmm.score(self.model, self.model["features"], X, self.uncertain_threshold)
+        return {"sampleid": sampleid, "features": features, "Predict": str(predict[0]), "karyotypes": str(karyotype[0]),
+                "uncertainty": float(uncertainty[0]), "seconds": round(time.time() - start, 3)}
+
+    def submit(self, sampleid, alignment, input_vcf, fill_type=None):
+        '''Run a submission on the pool, or return None when the queue is full'''
+        if not self.slots.acquire(blocking=False):
+            return None
+        future = self.pool.submit(self.score, sampleid, alignment, input_vcf, fill_type)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+class Handler(BaseHTTPRequestHandler):
+    scorer = None
+
+    def reply(self, status, body, content_type="application/json"):
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.reply(200, {"status": "ok", "features": self.scorer.model["features"], "model": self.scorer.model["model"]})
+        elif self.path == "/metrics":
+            self.reply(200, METRICS.prometheus(), "text/plain; version=0.0.4")
+        else:
+            self.reply(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/score":
+            return self.reply(404, {"error": f"Unknown path {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            sampleid, alignment, input_vcf = request["sampleid"], request["alignment"], request["vcf"]
+            if not all(isinstance(i, str) for i in [sampleid, alignment, input_vcf]):
+                raise ValueError("sampleid, alignment and vcf must be strings")
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, {"error": f"Expected a JSON body with sampleid, alignment and vcf ({e})"})
+        for path in [alignment, input_vcf]:
+            if not os.path.isfile(path):
+                return self.reply(400, {"error": f"{path} is not exist"})
+        if request.get("alignment_format") not in [None, "BAM", "CRAM"]:
+            return self.reply(400, {"error": f"alignment_format must be BAM or CRAM, got {request['alignment_format']}"})
+        future = self.scorer.submit(sampleid, alignment, input_vcf, request.get("alignment_format"))
+        if future is None:
+            return self.reply(503, {"error": "The scoring queue is full, please retry later"})
+        try:
+            self.reply(200, future.result())
+        except (Exception, SystemExit) as e:
+            self.reply(500, {"error": str(e)})
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve_main(argv):
+    parser = argparse.ArgumentParser(prog="seGMM serve", description = "Keep a reference model loaded and score single samples submitted over HTTP (POST /score with a JSON body {\"sampleid\", \"alignment\", \"vcf\"}); GET /metrics returns Prometheus metrics of the requests.",
+                                     parents=[extraction_options(), classification_options()])
+    parser.add_argument("--alignment_format","-a",required = False,help = "Default alignment format of submitted files. [default: BAM]",choices=["BAM","CRAM"],default="BAM")
+    parser.add_argument("--num_threshold","-n",required = False,help = "Number of samples processed concurrently. [default: 1].",default="1")
+    parser.add_argument("--queue",required = False,help = "Number of submissions allowed to wait for a worker before new ones are rejected with 503. [default: 16].",default="16")
+    parser.add_argument("--port","-p",required = False,help = "Port to listen on at 127.0.0.1. [default: 8765]",default="8765")
+    parser.add_argument("--socket",required = False,help = "Listen on this Unix socket instead of a TCP port.")
+    args = parser.parse_args(argv)
+    fasta = str(os.path.realpath(args.reference_fasta)) if args.reference_fasta else " "
+    if args.alignment_format == "CRAM" and fasta == " ":
+        sys.exit('Error, please provide reference genome file for CRAM support!')
+    METRICS.limit(METRICS_RECORDS)
+    Handler.scorer = Scorer(gmm.load_model(args.model), int(args.num_threshold), int(args.queue), args.alignment_format, fasta,
+                            args.quality, args.genome, float(args.uncertain_threshold), args.fast_index,
+                            FeatureCache(args.cache) if args.cache else None)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        print(f"seGMM is serving on unix socket {args.socket}")
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", int(args.port)), Handler)
+        print(f"seGMM is serving on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        Handler.scorer.pool.shutdown()
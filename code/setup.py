@@ -18,6 +18,7 @@ setup(
     platforms=["linux"],
     url='https://github.com/liusihan/seGMM',
     packages=find_packages(),
+    install_requires=['numpy'],
     entry_points={
         'console_scripts': [
             'seGMM = seGMM.main:main',
@@ -0,0 +1,99 @@
+############################################################################
+# File Name: table
+# Description: in-memory feature table keyed by sample id
+############################################################################
+
+import numpy as np
+
+FEATURES = ["XH", "Xmap", "Ymap", "XYratio", "SRY"]
+
+class FeatureTable:
+    '''Columns of per-sample values keyed by sample id.
+
+    Every column is a NumPy array aligned with `ids`. Tables are combined by
+    sample id (join) or stacked (concat), never by line position, so features
+    collected in different sample orders cannot be mixed up.
+    '''
+
+    def __init__(self, ids, columns=None):
+        self.ids = list(ids)
+        if len(set(self.ids)) != len(self.ids):
+            raise ValueError(f"Duplicated sample ids: {', '.join(sorted({i for i in self.ids if self.ids.count(i) > 1}))}")
+        self.index = {sampleid: k for k, sampleid in enumerate(self.ids)}
+        self.columns = {}
+        for name, values in (columns or {}).items():
+            self[name] = values
+
+    @classmethod
+    def from_values(cls, name, values):
+        '''Build a one-column table from a {sampleid: value} dict, sorted by sample id'''
+        ids = sorted(values)
+        return cls(ids, {name: [values[i] for i in ids]})
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        if isinstance(values, dict):
+            values = [values[i] for i in self.ids]
+        values = np.asarray(values)
+        if values.dtype.kind not in "fiub":
+            values = values.astype(object)
+        if len(values) != len(self.ids):
+            raise ValueError(f"Column {name} has {len(values)} values for {len(self.ids)} samples")
+        self.columns[name] = values
+
+    def select(self, names=None, ids=None):
+        '''Table with only the given columns and/or samples, in the given order'''
+        names = self.names if names is None else list(names)
+        ids = self.ids if ids is None else list(ids)
+        rows = [self.index[i] for i in ids]
+        return FeatureTable(ids, {name: self.columns[name][rows] for name in names})
+
+    def join(self, other):
+        '''Inner join on sample id, keeping the sample order of this table'''
+        ids = [i for i in self.ids if i in other.index]
+        table = self.select(ids=ids)
+        for name, values in other.select(ids=ids).columns.items():
+            table[name] = values
+        return table
+
+    def concat(self, other):
+        '''Rows of this table followed by the rows of other, which must have the same columns'''
+        if sorted(self.names) != sorted(other.names):
+            raise ValueError(f"Cannot stack tables with features {', '.join(self.names)} and {', '.join(other.names)}")
+        return FeatureTable(self.ids + other.ids, {name: np.concatenate([self.columns[name], other.columns[name]]) for name in self.names})
+
+    def matrix(self, names=None):
+        '''Samples x features float matrix of the given columns'''
+        names = self.names if names is None else list(names)
+        return np.column_stack([np.asarray(self.columns[name], dtype=float) for name in names]) if names else np.empty((len(self), 0))
+
+    def rows(self):
+        for k, sampleid in enumerate(self.ids):
+            yield sampleid, [self.columns[name][k] for name in self.columns]
+
+    @classmethod
+    def read(cls, path):
+        '''Read a feature file (sampleid + feature columns, tab separated)'''
+        with open(path) as f:
+            names = f.readline().rstrip("\n").split("\t")[1:]
+            rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+        return cls([i[0] for i in rows], {name: [float(i[k+1]) for i in rows] for k, name in enumerate(names)})
+
+    def write(self, path):
+        '''Write the table as a feature file readable by seGMM.r and gmm.read_features'''
+        with open(path, "w") as f:
+            f.write("\t".join(["sampleid"] + self.names) + "\n")
+            for sampleid, values in self.rows():
+                f.write("\t".join([sampleid] + [str(float(i)) if isinstance(i, (float, np.floating)) else str(i) for i in values]) + "\n")
@@ -0,0 +1,87 @@
+############################################################################
+# File Name: test_gmm_parity
+# Description: the NumPy GMM backend against mclust (script/seGMM.r)
+############################################################################
+
+import importlib.util, os, shutil, subprocess, sys, tempfile, unittest
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+DATA = Path(__file__).absolute().parent / "data"
+PANELS = ["1000G.WES", "1000G.WGS"]
+UNCERTAINTY_TOLERANCE = 1e-3
+# data/<panel>.mclust.txt hold the calls and uncertainties of seGMM.r/mclust on the bundled panels.
+# They can only be written where R and mclust are installed: `python tests/test_gmm_parity.py --write-fixtures`.
+# Without them test_fixture is skipped; it is never compared with output of the NumPy backend itself.
+UNCERTAINTY_R = '''suppressMessages(library(mclust))
+args <- commandArgs(trailingOnly = TRUE)
+feature <- read.table(args[1], head = T, stringsAsFactors = F, row.names=1, sep="\\t")
+em <- Mclust(as.data.frame(scale(feature)), G = 2)
+write.table(data.frame(uncertainty=em$uncertainty, row.names=rownames(feature)), args[2], sep="\\t", quote=FALSE)
+'''
+
+spec = importlib.util.spec_from_file_location("gmm", ROOT / "code" / "gmm.py")
+gmm = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(gmm)
+
+def read_result(path):
+    '''{sampleid: [columns...]} of a table written by R write.table (no column name for the row names)'''
+    with open(path) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+    return header, {row[0].strip('"'): [i.strip('"') for i in row[1:]] for row in rows}
+
+def python_result(panel):
+    '''{sampleid: (Predict, karyotypes, uncertainty)} of the NumPy backend'''
+    ids, names, X = gmm.read_features(ROOT / "reference" / f"{panel}.txt")
+    predict, karyotype, uncertainty, _ = gmm.classify(names, X, 0.1)
+    return {sampleid: (str(p), str(k), float(u)) for sampleid, p, k, u in zip(ids, predict, karyotype, uncertainty)}
+
+def mclust_result(panel):
+    '''{sampleid: (Predict, karyotypes, uncertainty)} of script/seGMM.r and mclust, run with Rscript'''
+    reference = str(ROOT / "reference" / f"{panel}.txt")
+    with tempfile.TemporaryDirectory() as outdir:
+        subprocess.run(["Rscript", str(ROOT / "code" / "script" / "seGMM.r"), reference, "0.1", outdir], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(["Rscript", "-e", UNCERTAINTY_R, reference, outdir+"/uncertainty.txt"], check=True, stdout=subprocess.DEVNULL)
+        header, calls = read_result(os.path.join(outdir, "seGMM_result.txt"))
+        _, uncertainty = read_result(os.path.join(outdir, "uncertainty.txt"))
+    predict, karyotype = header.index("Predict"), header.index("karyotypes")
+    return {sampleid: (row[predict], row[karyotype], float(uncertainty[sampleid][0])) for sampleid, row in calls.items()}
+
+def read_fixture(path):
+    header, rows = read_result(path)
+    return {sampleid: (row[0], row[1], float(row[2])) for sampleid, row in rows.items()}
+
+def write_fixtures():
+    DATA.mkdir(exist_ok=True)
+    for panel in PANELS:
+        with open(DATA / f"{panel}.mclust.txt", "w") as f:
+            f.write("Predict\tkaryotypes\tuncertainty\n")
+            for sampleid, (predict, karyotype, uncertainty) in mclust_result(panel).items():
+                f.write(f"{sampleid}\t{predict}\t{karyotype}\t{uncertainty!r}\n")
+
+class TestReferencePanels(unittest.TestCase):
+
+    def assertSameCalls(self, result, expected):
+        self.assertEqual(sorted(result), sorted(expected))
+        self.assertEqual({k: v[:2] for k, v in result.items()}, {k: v[:2] for k, v in expected.items()})
+        for sampleid, (_, _, uncertainty) in expected.items():
+            self.assertAlmostEqual(result[sampleid][2], uncertainty, delta=UNCERTAINTY_TOLERANCE, msg=sampleid)
+
+    @unittest.skipUnless(all((DATA / f"{panel}.mclust.txt").is_file() for panel in PANELS), "the mclust fixtures have not been written")
+    def test_fixture(self):
+        for panel in PANELS:
+            with self.subTest(panel=panel):
+                self.assertSameCalls(python_result(panel), read_fixture(DATA / f"{panel}.mclust.txt"))
+
+    @unittest.skipUnless(shutil.which("Rscript"), "Rscript is not installed")
+    def test_mclust(self):
+        for panel in PANELS:
+            with self.subTest(panel=panel):
+                self.assertSameCalls(python_result(panel), mclust_result(panel))
+
+if __name__ == '__main__':
+    if "--write-fixtures" in sys.argv:
+        write_fixtures()
+    else:
+        unittest.main()
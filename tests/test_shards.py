@@ -0,0 +1,76 @@
+############################################################################
+# File Name: test_shards
+# Description: XH counts of --shard runs against one unsharded count, and seGMM merge checks
+############################################################################
+
+import json, random, sys, tempfile, unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent / "code"))
+import main
+
+SAMPLES = ["A", "B", "C", "D"]
+GENOTYPES = ["0/0", "0/1", "1/1", "0|1", "./.", "1/2", "0", "1"]
+
+def write_vcf(path, records=50, seed=1):
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write("##fileformat=VCFv4.2\n")
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(SAMPLES) + "\n")
+        for pos in range(1, records + 1):
+            chrom = rng.choice(["X", "chrX", "1"])
+            f.write(f"{chrom}\t{pos}\t.\tA\tG\t50\tPASS\t.\tGT:DP\t" + "\t".join(f"{rng.choice(GENOTYPES)}:5" for _ in SAMPLES) + "\n")
+        f.write(f"X\t{records + 1}\t.\tA\tG\t50\tPASS\t.\n")
+
+def write_shard(path, i, n, params, het_called):
+    with open(path, "w") as f:
+        f.write(f"#shard\t{i}/{n}\tXH\t{json.dumps(params, sort_keys=True)}\n")
+        f.write("sampleid\ttotal\tX\tY\tSRY\tXH_het\tXH_called\n")
+        for sampleid, (het, called) in het_called.items():
+            f.write(f"{sampleid}\tNA\tNA\tNA\tNA\t{het}\t{called}\n")
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.vcf = f"{self.tmp.name}/cohort.vcf"
+        write_vcf(self.vcf)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_XH_sums(self):
+        samples, het, called = main.count_XH(self.vcf, chunk_size=7)
+        for n in [1, 2, 3, 8]:
+            with self.subTest(shards=n):
+                shards = [main.count_XH(self.vcf, 7, (i, n)) for i in range(n)]
+                self.assertTrue(all(i[0] == samples for i in shards))
+                self.assertEqual(sum(i[1] for i in shards).tolist(), het.tolist())
+                self.assertEqual(sum(i[2] for i in shards).tolist(), called.tolist())
+
+    def test_merge_XH(self):
+        samples, het, called = main.count_XH(self.vcf)
+        params = main.shard_params(self.vcf, self.vcf, "BAM", "30", "hg19", False)
+        files = []
+        for i in range(3):
+            _, h, c = main.count_XH(self.vcf, shard=(i, 3))
+            files.append(f"{self.tmp.name}/shard_{i}_of_3.txt")
+            write_shard(files[-1], i, 3, params, {s: (int(a), int(b)) for s, a, b in zip(samples, h, c)})
+        table = main.merge_shards(files)
+        self.assertEqual(table.ids, sorted(samples))
+        expected = {s: a/b if b else 0.0 for s, a, b in zip(samples, het, called)}
+        self.assertEqual({s: float(x) for s, x in zip(table.ids, table["XH"])}, expected)
+
+    def test_merge_different_parameters(self):
+        params = main.shard_params(self.vcf, self.vcf, "BAM", "30", "hg19", False)
+        for key, value in [("quality", "20"), ("genome", "hg38"), ("fast_index", True), ("vcf", "/other.vcf")]:
+            with self.subTest(key=key):
+                files = [f"{self.tmp.name}/shard_0_of_2.txt", f"{self.tmp.name}/shard_1_of_2.txt"]
+                write_shard(files[0], 0, 2, params, {"A": (1, 2)})
+                write_shard(files[1], 1, 2, dict(params, **{key: value}), {"A": (1, 2)})
+                with self.assertRaises(SystemExit) as e:
+                    main.merge_shards(files)
+                self.assertIn(key, str(e.exception))
+
+if __name__ == '__main__':
+    unittest.main()